@@ -0,0 +1,240 @@
+'''
+Benchmarks for the heuristics of lib_autopilot
+
+The benchmarks either run on a recorded network (a graph snapshot or legacy
+pickle file as written by c-lightning-autopilot.py) or on a synthetic scale-free graph which is
+generated with the Barabasi Albert model and random channel capacities.
+
+usage: benchmark.py centrality [-h] [-i INPUT] [-n NODES] [-m EDGES]
+                               [-k SAMPLES] [-t TOP]
+       benchmark.py snapshot [-h] [-i INPUT] [-n NODES] [-m EDGES]
+                             [-k SAMPLES]
+       benchmark.py load [-h] [-i INPUT] [-n NODES] [-m EDGES]
+
+a good example call of the program could look like that:
+
+python3 benchmark.py centrality -n 5000 -k 250
+
+This call compares the exact betweenness centrality of a 5000 node graph with
+the approximation that only samples 250 source nodes.
+
+python3 benchmark.py snapshot -n 50000
+
+This call compares memory and run time of the networkx graph and the CSR
+GraphSnapshot for capacity sums, degrees and breadth first searches.
+
+python3 benchmark.py load -n 50000
+
+This call compares the time to load the network from a pickle file with the
+time to load it from a snapshot file.
+'''
+
+import argparse
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+
+import networkx as nx
+import numpy as np
+
+from graph_snapshot import GraphSnapshot, load_graph_file
+from lib_autopilot import approximate_betweenness, path_length_sums
+
+
+def generate_graph(num_nodes=2000, edges_per_node=2, seed=None):
+    """
+    generates a scale-free channel graph with random capacities
+
+    capacities are drawn from a log-normal distribution so that they roughly
+    follow the skewed channel sizes of the lightning network
+    """
+    G = nx.barabasi_albert_graph(num_nodes, edges_per_node, seed=seed)
+    rng = np.random.default_rng(seed)
+    capacities = rng.lognormal(mean=13, sigma=1.2, size=G.number_of_edges())
+    for (n, m), satoshis in zip(G.edges(), capacities):
+        G[n][m]["satoshis"] = int(max(20000, satoshis))
+    return G
+
+
+def load_graph(args):
+    if args.input:
+        return load_graph_file(args.input).to_networkx()
+    return generate_graph(args.nodes, args.edges, seed=1)
+
+
+def rank_correlation(a, b):
+    """ spearman rank correlation of two score vectors (ties not averaged) """
+    rank_a = np.argsort(np.argsort(a))
+    rank_b = np.argsort(np.argsort(b))
+    return np.corrcoef(rank_a, rank_b)[0, 1]
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def compare_centrality(G, samples, top=100):
+    """
+    compares sampled against exact betweenness centrality
+
+    returns run times, the spearman rank correlation, the overlap of the top
+    ranked nodes and the total variation distance of both probability
+    distributions which are used by the autopilot to draw candidates
+    """
+    snapshot = GraphSnapshot.from_networkx(G)
+    (a, _), exact_time = timed(approximate_betweenness, snapshot)
+    (b, bound), approx_time = timed(approximate_betweenness, snapshot,
+                                    samples, 1, None,
+                                    np.random.default_rng(1))
+    top_a = set(np.argsort(a)[::-1][:top])
+    top_b = set(np.argsort(b)[::-1][:top])
+
+    return {
+        "nodes": snapshot.num_nodes,
+        "samples": samples,
+        "exact_seconds": exact_time,
+        "approx_seconds": approx_time,
+        "speedup": exact_time / approx_time,
+        "error_bound": bound,
+        "rank_correlation": rank_correlation(a, b),
+        "top_overlap": len(top_a & top_b) / top,
+        "total_variation": 0.5 * np.abs(a / a.sum() - b / b.sum()).sum(),
+    }
+
+
+def compare_snapshot(G, samples=10):
+    """
+    compares the networkx graph with its CSR snapshot
+
+    memory is measured with tracemalloc while copying G respectively building
+    the snapshot. Run times are measured for the operations the heuristics
+    need: capacity sums, degrees and breadth first searches from samples
+    sources
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    G = G.copy()
+    graph_bytes = tracemalloc.get_traced_memory()[0] - before
+    before = tracemalloc.get_traced_memory()[0]
+    snapshot = GraphSnapshot.from_networkx(G)
+    snapshot_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    snapshot, build_time = timed(GraphSnapshot.from_networkx, G)
+
+    _, nx_capacity_time = timed(lambda: {
+        n: sum(G.get_edge_data(n, m)["satoshis"] for m in G.neighbors(n))
+        for n in G.nodes()})
+    _, csr_capacity_time = timed(snapshot.capacity_sums)
+
+    _, nx_degree_time = timed(lambda: dict(G.degree()))
+    _, csr_degree_time = timed(snapshot.degrees)
+
+    sources = list(G.nodes())[:samples]
+    _, nx_bfs_time = timed(lambda: [
+        sum(nx.single_source_shortest_path_length(G, s).values())
+        for s in sources])
+    _, csr_bfs_time = timed(path_length_sums, snapshot, samples)
+
+    return {
+        "nodes": snapshot.num_nodes,
+        "edges": snapshot.num_edges,
+        "networkx_mbytes": graph_bytes / 2**20,
+        "snapshot_mbytes": snapshot_bytes / 2**20,
+        "snapshot_array_mbytes": snapshot.nbytes() / 2**20,
+        "build_seconds": build_time,
+        "networkx_capacity_seconds": nx_capacity_time,
+        "snapshot_capacity_seconds": csr_capacity_time,
+        "networkx_degree_seconds": nx_degree_time,
+        "snapshot_degree_seconds": csr_degree_time,
+        "networkx_bfs_seconds": nx_bfs_time,
+        "snapshot_bfs_seconds": csr_bfs_time,
+    }
+
+
+def compare_loading(G):
+    """
+    compares loading a pickled networkx graph with loading a snapshot file
+
+    the snapshot file is memory-mapped, only node ids and aliases are decoded
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        pickle_path = os.path.join(directory, "graph.pickle")
+        snapshot_path = os.path.join(directory, "graph.snapshot")
+        with open(pickle_path, "wb") as outfile:
+            pickle.dump(G, outfile, pickle.HIGHEST_PROTOCOL)
+        GraphSnapshot.from_networkx(G).save(snapshot_path)
+
+        def load_pickle():
+            with open(pickle_path, "rb") as infile:
+                return pickle.load(infile)
+
+        _, pickle_time = timed(load_pickle)
+        _, snapshot_time = timed(GraphSnapshot.load, snapshot_path)
+        return {
+            "nodes": G.number_of_nodes(),
+            "edges": G.number_of_edges(),
+            "pickle_mbytes": os.path.getsize(pickle_path) / 2**20,
+            "snapshot_mbytes": os.path.getsize(snapshot_path) / 2**20,
+            "pickle_load_seconds": pickle_time,
+            "snapshot_load_seconds": snapshot_time,
+        }
+
+
+def print_result(result):
+    for k, v in result.items():
+        if isinstance(v, float):
+            v = "{:.4f}".format(v)
+        print("{:28} {}".format(k, v))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    centrality = subparsers.add_parser(
+        "centrality", help="compare sampled and exact betweenness centrality")
+    centrality.add_argument("-i", "--input",
+                            help="points to a graph snapshot or pickle file")
+    centrality.add_argument("-n", "--nodes", type=int, default=2000,
+                            help="number of nodes of the generated graph")
+    centrality.add_argument("-m", "--edges", type=int, default=2,
+                            help="edges per new node of the generated graph")
+    centrality.add_argument("-k", "--samples", type=int, default=200,
+                            help="number of sampled source nodes")
+    centrality.add_argument("-t", "--top", type=int, default=100,
+                            help="size of the top ranking to compare")
+
+    snapshot = subparsers.add_parser(
+        "snapshot", help="compare the networkx graph with its CSR snapshot")
+    snapshot.add_argument("-i", "--input",
+                          help="points to a graph snapshot or pickle file")
+    snapshot.add_argument("-n", "--nodes", type=int, default=50000,
+                          help="number of nodes of the generated graph")
+    snapshot.add_argument("-m", "--edges", type=int, default=2,
+                          help="edges per new node of the generated graph")
+    snapshot.add_argument("-k", "--samples", type=int, default=10,
+                          help="number of breadth first searches")
+
+    load = subparsers.add_parser(
+        "load", help="compare loading a pickle file and a snapshot file")
+    load.add_argument("-i", "--input",
+                      help="points to a graph snapshot or pickle file")
+    load.add_argument("-n", "--nodes", type=int, default=50000,
+                      help="number of nodes of the generated graph")
+    load.add_argument("-m", "--edges", type=int, default=2,
+                      help="edges per new node of the generated graph")
+
+    args = parser.parse_args()
+    if args.benchmark == "centrality":
+        print_result(compare_centrality(load_graph(args), args.samples,
+                                        args.top))
+    elif args.benchmark == "snapshot":
+        print_result(compare_snapshot(load_graph(args), args.samples))
+    elif args.benchmark == "load":
+        print_result(compare_loading(load_graph(args)))
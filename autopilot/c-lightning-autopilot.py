@@ -12,27 +12,61 @@ python3 c-lightning-autopilot --help
 
 in order to get all the command line options
 
-usage: c-lightning-autopilot.py [-h] [-b BALANCE] [-c CHANNELS]
+usage: c-lightning-autopilot.py [-h] [-b BALANCE [BALANCE ...]]
+                                [-c CHANNELS [CHANNELS ...]]
                                 [-r PATH_TO_RPC_INTERFACE]
-                                [-s {diverse,merge}] [-p PERCENTILE_CUTOFF]
+                                [-s {diverse,merge} [{diverse,merge} ...]]
+                                [-p PERCENTILE_CUTOFF [PERCENTILE_CUTOFF ...]]
                                 [-d] [-i INPUT]
+                                [--centrality_samples CENTRALITY_SAMPLES]
+                                [--path_samples PATH_SAMPLES] [-w WORKERS]
+                                [--no_cache] [--cache_entries CACHE_ENTRIES]
+                                [--seed SEED] [--max_share MAX_SHARE]
+                                [--plan] [--parallel PARALLEL]
+                                [--connect_timeout CONNECT_TIMEOUT]
+                                [--ban NODEID [NODEID ...]]
 
 optional arguments:
   -h, --help            show this help message and exit
-  -b BALANCE, --balance BALANCE
+  -b BALANCE [BALANCE ...], --balance BALANCE [BALANCE ...]
                         use specified number of satoshis to open all channels
-  -c CHANNELS, --channels CHANNELS
+  -c CHANNELS [CHANNELS ...], --channels CHANNELS [CHANNELS ...]
                         opens specified amount of channels
   -r PATH_TO_RPC_INTERFACE, --path_to_rpc_interface PATH_TO_RPC_INTERFACE
                         specifies the path to the rpc_interface
-  -s {diverse,merge}, --strategy {diverse,merge}
+  -s {diverse,merge} [{diverse,merge} ...], --strategy {diverse,merge} [{diverse,merge} ...]
                         defines the strategy
-  -p PERCENTILE_CUTOFF, --percentile_cutoff PERCENTILE_CUTOFF
+  -p PERCENTILE_CUTOFF [PERCENTILE_CUTOFF ...], --percentile_cutoff PERCENTILE_CUTOFF [PERCENTILE_CUTOFF ...]
                         only uses the top percentile of each probability
-                        distribution
+                        distribution (none for no cutoff)
   -d, --dont_store      don't store the network on the hard drive
   -i INPUT, --input INPUT
-                        points to a pickle file
+                        points to a graph snapshot (or a legacy pickle file)
+  --centrality_samples CENTRALITY_SAMPLES
+                        approximate the betweenness centrality by sampling
+                        this number of source nodes
+  --path_samples PATH_SAMPLES
+                        estimate the path length sums from this number of
+                        sampled source nodes
+  -w WORKERS, --workers WORKERS
+                        number of processes used to compute the heuristics
+  --no_cache            don't cache the heuristic scores next to the network
+  --cache_entries CACHE_ENTRIES
+                        number of cached networks to keep on the hard drive
+  --seed SEED           seed of the random number generator to reproduce the
+                        sampled candidates
+  --max_share MAX_SHARE
+                        no channel gets more than this fraction of the total
+                        capacity of its destination node (e.g. 0.5)
+  --plan                only print the proposed channels for every
+                        combination of the given balances, channels,
+                        strategies and percentiles instead of opening them
+  --parallel PARALLEL   number of peers to connect to at the same time
+  --connect_timeout CONNECT_TIMEOUT
+                        seconds to wait for a peer before it is replaced by
+                        another candidate
+  --ban NODEID [NODEID ...]
+                        never propose channels with these nodes
 
 a good example call of the program could look like that: 
 
@@ -41,45 +75,411 @@ python3 c-lightning-autopilot.py -s diverse -c 30 -b 10000000
 This call would use up to 10'000'000 satoshi to create 30 channels which are
 generated by using the diverse strategy to mix the 4 heuristics. 
 
-Currently the software will not check, if sufficient funds are available
-or if a channel already exists.
+The scores of the heuristics are cached next to the stored network (in the
+directory lightning_network_scores) and reused as long as the network
+did not change. Running the autopilot again with -i and other values for
+--strategy, --channels or --percentile_cutoff is therefore almost instant.
+
+python3 c-lightning-autopilot.py --plan -i lightning_network.snapshot \
+    -b 1000000 10000000 -c 10 30 -s diverse merge -p none 0.5
+
+This call opens no channels. It computes the heuristics once and prints the
+proposed channels and amounts for all 16 combinations of the settings.
+
+Connections to the candidates are set up in parallel (--parallel). Peers
+which fail or do not answer within --connect_timeout seconds are replaced by
+further candidates. The channels are funded once all connections are set
+up, with a single multifundchannel call if lightningd supports it.
+
+Our own node, our current peers (which includes nodes with open or pending
+channels) and the nodes given with --ban are never proposed.
+
+Currently the software will not check, if sufficient funds are available.
 '''
 
-from os.path import expanduser
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from os.path import expanduser, splitext
 import argparse
 import logging
-import math
-import pickle
+import random
+import resource
 import sys
+import threading
+import time
 
 from lightning import LightningRpc
 import dns.resolver
 
 from bech32 import bech32_decode, CHARSET, convertbits
+from graph_snapshot import SnapshotBuilder, load_graph_file
 from lib_autopilot import Autopilot
 from lib_autopilot import Strategy
-import networkx as nx
+from rpc_stream import stream_rpc_array
+from score_cache import ScoreCache
+
+
+class CLightning_autopilot(Autopilot):
+
+    def __init__(self, path, input=None, dont_store=None, **kwargs):
+        self.__add_clogger()
+
+        self.__rpc_path = path
+        self.__rpc_interface = LightningRpc(path)
+        self.__clogger.info("connection to RPC interface successful")
+
+        G = None
+        if input:
+            try:
+                self.__clogger.info(
+                    "Try to load graph from file system at: {}".format(input))
+                start = time.time()
+                G = load_graph_file(input)
+                self.__clogger.info(
+                    "Successfully restored the lightning network graph from {} in {:.3f} seconds".format(
+                        input, time.time() - start))
+            except FileNotFoundError:
+                self.__clogger.info(
+                    "input file not found. Load the graph from the peers of the lightning network")
+                G = self.__download_graph()
+        else:
+            self.__clogger.info(
+                "no input specified download graph from peers")
+            G = self.__download_graph()
+
+        if not dont_store:
+            G.save("lightning_network.snapshot")
+
+        Autopilot.__init__(self, G, **kwargs)
+
+    def __add_clogger(self):
+        """ initiates the logging service for this class """
+        # FIXME: adapt to the settings that are proper for you
+        self.__clogger = logging.getLogger('clightning-autopilot')
+        self.__clogger.setLevel(logging.INFO)
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        ch.setFormatter(formatter)
+        self.__clogger.addHandler(ch)
+        self.__clogger.info("set up logging infrastructure")
+
+    def __get_seed_keys(self):
+        """
+        retrieve the nodeids of the ln seed nodes from lseed.bitcoinstats.com
+        """
+        domain = "lseed.bitcoinstats.com"
+        srv_records = dns.resolver.query(domain, "SRV")
+        res = []
+        for srv in srv_records:
+            bech32 = str(srv.target).rstrip(".").split(".")[0]
+            data = bech32_decode(bech32)[1]
+            decoded = convertbits(data, 5, 4)
+            res.append("".join(
+                ['{:1x}'.format(integer) for integer in decoded])[:-1])
+        return res
+
+    def __connect_to_seeds(self):
+        """
+        sets up peering connection to seed nodes of the lightning network
+
+        This is necessary in case the node operating the autopilot has never
+        been connected to the lightning network.
+        """
+        try:
+            seed_keys = self.__get_seed_keys()
+            random.shuffle(seed_keys)
+            for nodeid in seed_keys:
+                self.__clogger.info("peering with node: " + nodeid)
+                self.__rpc_interface.connect(nodeid)
+                # FIXME: better strategy than sleep(2) for building up
+                time.sleep(2)
+        except Exception as e:
+            self.__clogger.info("Could not connect to seed nodes: " + str(e))
+
+    def __download_graph(self):
+        """
+        Downloads a local copy of the nodes view of the lightning network
+
+        This copy is retrieved by listnodes and listchannels RPC calls and
+        will thus be incomplete as peering might not be ready yet. Both
+        responses are parsed incrementally and written straight into a
+        SnapshotBuilder, so neither the full JSON responses nor a networkx
+        graph are held in memory.
+        """
+        builder = SnapshotBuilder()
+        self.__clogger.info("Instantiated snapshot builder to store the lightning network")
+
+        try:
+            self.__clogger.info(
+                "Attempt RPC-call to download nodes from the lightning network")
+            while builder.num_nodes == 0:
+                peers = self.__rpc_interface.listpeers()["peers"]
+                if len(peers) < 1:
+                    self.__connect_to_seeds()
+                for node in stream_rpc_array(self.__rpc_path, "listnodes",
+                                             "nodes"):
+                    builder.add_node(node["nodeid"], node.get("alias"))
+        except ValueError as e:
+            self.__clogger.info(
+                "Node list could not be retrieved from the peers of the lightning network")
+            self.__clogger.debug("RPC error: " + str(e))
+            raise e
+
+        self.__clogger.info(
+            "Number of nodes found and added to the local snapshot: {}".format(
+                builder.num_nodes))
+
+        try:
+            self.__clogger.info(
+                "Attempt RPC-call to download channels from the lightning network")
+            retrieved = 0
+            for channel in stream_rpc_array(self.__rpc_path, "listchannels",
+                                            "channels"):
+                retrieved += 1
+                builder.add_channel(channel["short_channel_id"],
+                                    channel["source"],
+                                    channel["destination"],
+                                    channel["satoshis"])
+            self.__clogger.info(
+                "Number of retrieved channels: {} ({} without duplicate directions)".format(
+                    retrieved, builder.num_channels))
+        except ValueError as e:
+            self.__clogger.info(
+                "Channel list could not be retrieved from the peers of the lightning network")
+            self.__clogger.debug("RPC error: " + str(e))
+            raise e
+
+        self.__clogger.info(
+            "Channel arrays use {:.1f} MiB, peak memory of the process: {:.1f} MiB".format(
+                builder.nbytes() / 2**20, self.__peak_memory()))
+        snapshot = builder.build()
+        self.__clogger.info(
+            "Built snapshot with {} nodes and {} edges, peak memory of the process: {:.1f} MiB".format(
+                snapshot.num_nodes, snapshot.num_edges, self.__peak_memory()))
+        return snapshot
+
+    @staticmethod
+    def __peak_memory():
+        """ peak resident memory of this process in MiB """
+        # ru_maxrss is reported in KiB on linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return peak / 2**20
+        return peak / 2**10
+
+    def connect(self, candidates, balance=1000000, max_share=None, spares=(),
+                parallel=8, timeout=30):
+        """
+        connects to the candidates and funds channels with the balance
+
+        up to parallel connections are attempted at the same time, in the
+        order of the ranking of calculate_statistics. A peer which did not
+        connect within timeout seconds is given up and, like every failed
+        peer, replaced by the best ranked of the remaining candidates and
+        spares. Once the connections are set up the balance is split among
+        the connected peers and all channels are funded with a single
+        multifundchannel call if lightningd supports it.
+        """
+        queue = (self.__rank(candidates) +
+                 self.__rank([s for s in spares if s not in candidates]))
+        connected = self.__connect_all(queue, len(candidates), parallel,
+                                       timeout)
+        if not connected:
+            self.__clogger.info("Could not connect to any candidate")
+            return
+
+        pdf = self.calculate_statistics(connected)
+        connection_dict = self.calculate_proposed_channel_capacities(
+            pdf, balance, max_share)
+        if self.__supports("multifundchannel") and len(connection_dict) > 1:
+            try:
+                self.__clogger.info(
+                    "Try to open {} channels with a capacity of {} in one transaction".format(
+                        len(connection_dict), sum(connection_dict.values())))
+                self.__rpc_interface.call("multifundchannel", {
+                    "destinations": [{"id": nodeid, "amount": satoshis}
+                                     for nodeid, satoshis in connection_dict.items()]})
+                return
+            except ValueError as e:
+                self.__clogger.info(
+                    "Could not open the channels in one transaction, fund them one by one. Error: {}".format(
+                        str(e)))
+
+        for nodeid, satoshis in connection_dict.items():
+            try:
+                self.__clogger.info(
+                    "Try to open channel with a capacity of {} to node {}".format(
+                        satoshis, nodeid))
+                self.__rpc_interface.fundchannel(nodeid, satoshis)
+            except ValueError as e:
+                self.__clogger.info(
+                    "Could not open a channel to {} with capacity of {}. Error: {}".format(
+                        nodeid, satoshis, str(e)))
+
+    def exclusions(self, banned=()):
+        """
+        exclusion index of our own node, our peers and the banned nodes
+
+        peers include nodes to which we have channels in any state, so
+        pending channel opens are excluded as well
+        """
+        node_ids = set(banned)
+        try:
+            node_ids.add(self.__rpc_interface.getinfo()["id"])
+            for peer in self.__rpc_interface.listpeers()["peers"]:
+                node_ids.add(peer["id"])
+        except (ValueError, OSError) as e:
+            self.__clogger.info(
+                "Could not retrieve our peers, only exclude banned nodes. Error: {}".format(
+                    str(e)))
+        return self.exclusion_index(node_ids)
+
+    def __rank(self, candidates):
+        """ candidates in descending order of their proposed share of funds """
+        if not candidates:
+            return []
+        pdf = self.calculate_statistics(candidates, verbose=False)
+        return sorted(pdf, key=pdf.get, reverse=True)
+
+    def __connect_all(self, queue, num_peers, parallel, timeout):
+        """
+        connects to the first num_peers nodes of queue which accept the
+        connection within timeout seconds, with at most parallel attempts
+        at a time
+        """
+        queue = list(queue)
+        connected = []
+        running = {}
+        while queue or running:
+            while queue and len(running) < parallel and \
+                    len(connected) + len(running) < num_peers:
+                nodeid = queue.pop(0)
+                self.__clogger.info("Try to connect to node {}".format(nodeid))
+                future = self.__start_connect(nodeid)
+                running[future] = (nodeid, time.time() + timeout)
+            if not running:
+                break
+
+            next_deadline = min(deadline for _, deadline in running.values())
+            done, _ = wait(running, max(0, next_deadline - time.time()),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                nodeid, _ = running.pop(future)
+                try:
+                    future.result()
+                    connected.append(nodeid)
+                except Exception as e:
+                    self.__clogger.info(
+                        "Could not connect to {}. Error: {}".format(
+                            nodeid, str(e)))
+            now = time.time()
+            for future, (nodeid, deadline) in list(running.items()):
+                if deadline <= now:
+                    del running[future]
+                    self.__clogger.info(
+                        "Connecting to {} timed out after {} seconds".format(
+                            nodeid, timeout))
+
+        self.__clogger.info("Connected to {} of {} wanted peers".format(
+            len(connected), num_peers))
+        return connected
+
+    def __start_connect(self, nodeid):
+        """
+        connects to nodeid in a thread of its own and returns its future
+
+        a connect call which timed out keeps its thread until lightningd
+        answers, so it must not occupy a slot of a pool the replacement
+        peers are waiting for
+        """
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(self.__rpc_interface.connect(nodeid))
+            except Exception as e:
+                future.set_exception(e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def __supports(self, command):
+        """ checks whether lightningd knows the RPC command """
+        try:
+            commands = self.__rpc_interface.help()["help"]
+        except ValueError:
+            return False
+        return any(c["command"].split()[0] == command for c in commands)
+
+def print_plan(rows, snapshot):
+    """ prints the proposed channels of every combination of settings """
+    for row in rows:
+        proposal = row["proposal"]
+        print("strategy: {}  percentile: {}  channels: {}  balance: {}".format(
+            row["strategy"], row["percentile"], row["channels"],
+            row["balance"]))
+        print("  opens {} channels with {} satoshi".format(
+            len(proposal), sum(proposal.values())))
+        print("  {:>12}  {:66}  alias".format("satoshi", "nodeid"))
+        for nodeid, satoshis in proposal.items():
+            alias = snapshot.aliases[snapshot.index[nodeid]] or ""
+            print("  {:12}  {:66}  {}".format(satoshis, str(nodeid), alias))
+        print()
+
+
+def percentile_cutoff(value):
+    """ argparse type of the percentile cutoff, none disables the cutoff """
+    return None if value.lower() == "none" else float(value)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("-b", "--balance", 
-                        help="use specified number of satoshis to open all channels")
-    parser.add_argument("-c", "--channels", 
-                        help="opens specified amount of channels")
+    parser.add_argument("-b", "--balance", nargs="+", type=int,
+                        default=[1000000], help="use specified number of satoshis to open all channels")
+    parser.add_argument("-c", "--channels", nargs="+", type=int,
+                        default=[21], help="opens specified amount of channels")
     # FIXME: add the following command line option
     # parser.add_argument("-m", "--maxchannels", 
     #                help="opens channels as long as maxchannels is not reached")
     parser.add_argument("-r", "--path_to_rpc_interface", 
                     help="specifies the path to the rpc_interface")
     parser.add_argument("-s", "--strategy",choices=[Strategy.DIVERSE,Strategy.MERGE],
+                        nargs="+", default=[Strategy.DIVERSE],
                         help = "defines the strategy ")
-    parser.add_argument("-p", "--percentile_cutoff",
-                        help = "only uses the top percentile of each probability distribution")
+    parser.add_argument("-p", "--percentile_cutoff", nargs="+",
+                        type=percentile_cutoff, default=[None],
+                        help = "only uses the top percentile of each probability distribution (none for no cutoff)")
     parser.add_argument("-d", "--dont_store", action='store_true',
                         help = "don't store the network on the hard drive")
     parser.add_argument("-i", "--input",
-                        help = "points to a pickle file")
+                        help = "points to a graph snapshot (or a legacy pickle file)")
+    parser.add_argument("--centrality_samples", type=int,
+                        help = "approximate the betweenness centrality by sampling this number of source nodes")
+    parser.add_argument("--path_samples", type=int,
+                        help = "estimate the path length sums from this number of sampled source nodes")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help = "number of processes used to compute the heuristics")
+    parser.add_argument("--no_cache", action='store_true',
+                        help = "don't cache the heuristic scores next to the network")
+    parser.add_argument("--cache_entries", type=int, default=8,
+                        help = "number of cached networks to keep on the hard drive")
+    parser.add_argument("--seed", type=int,
+                        help = "seed of the random number generator to reproduce the sampled candidates")
+    parser.add_argument("--max_share", type=float,
+                        help = "no channel gets more than this fraction of the total capacity of its destination node (e.g. 0.5)")
+    parser.add_argument("--plan", action='store_true',
+                        help = "only print the proposed channels for every combination of the given balances, channels, strategies and percentiles instead of opening them")
+    parser.add_argument("--parallel", type=int, default=8,
+                        help = "number of peers to connect to at the same time")
+    parser.add_argument("--connect_timeout", type=float, default=30,
+                        help = "seconds to wait for a peer before it is replaced by another candidate")
+    parser.add_argument("--ban", nargs="+", metavar="NODEID", default=[],
+                        help = "never propose channels with these nodes")
     
 
     
@@ -88,29 +488,50 @@ if __name__ == '__main__':
     # FIXME: find ln-dir from lightningd.
     path = path = expanduser("~/.lightning/lightning-rpc")
     if args.path_to_rpc_interface is not None:
-        path=expanduser(parser.path-to-rpc-interface)
-    
-    balance = 1000000
-    if args.balance is not None:
-        # FIXME: parser.argument does not accept type = int
-        balance = int(args.balance)
+        path=expanduser(args.path_to_rpc_interface)
     
-    num_channels = 21
-    if args.channels is not None:
-        # FIXME: parser.argument does not accept type = int
-        num_channels = int(args.channels)
-        
-    percentile = None
-    if args.percentile_cutoff is not None:
-        # FIXME: parser.argument does not accept type = float
-        percentile = float(args.percentile_cutoff)
+    balances = args.balance
+    channel_counts = args.channels
+    strategies = args.strategy
+    percentiles = args.percentile_cutoff
+
+    if not args.plan and max(len(balances), len(channel_counts),
+                             len(strategies), len(percentiles)) > 1:
+        parser.error("several balances, channels, strategies or percentiles are only supported with --plan")
     
+    cache = None
+    if not args.no_cache:
+        graph_file = args.input or "lightning_network.snapshot"
+        cache = ScoreCache(splitext(graph_file)[0] + "_scores",
+                           args.cache_entries)
+
     autopilot = CLightning_autopilot(path, input = args.input,
-                                     dont_store = args.dont_store)
-    
-    candidates = autopilot.find_candidates(num_channels,
-                                           strategy = args.strategy,
-                                           percentile = percentile)
+                                     dont_store = args.dont_store,
+                                     centrality_samples = args.centrality_samples,
+                                     path_samples = args.path_samples,
+                                     workers = args.workers,
+                                     cache = cache,
+                                     seed = args.seed)
+
+    exclude = autopilot.exclusions(args.ban)
+
+    if args.plan:
+        print_plan(autopilot.plan(balances, channel_counts, strategies,
+                                  percentiles, args.max_share, exclude),
+                   autopilot.snapshot)
+        sys.exit(0)
+
+    candidates = autopilot.find_candidates(channel_counts[0],
+                                           strategy = strategies[0],
+                                           percentile = percentiles[0],
+                                           exclude = exclude)
+    # replacements for candidates which can not be connected
+    spares = autopilot.find_candidates(channel_counts[0],
+                                       strategy = strategies[0],
+                                       percentile = percentiles[0],
+                                       exclude = autopilot.exclusions(
+                                           args.ban + candidates))
 
-    autopilot.connect(candidates, balance)
+    autopilot.connect(candidates, balances[0], args.max_share, spares,
+                      args.parallel, args.connect_timeout)
     print("Autopilot finished. We hope it did a good job for you (and the lightning network). Thanks for using it.")
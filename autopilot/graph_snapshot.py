@@ -0,0 +1,467 @@
+'''
+Compact, immutable snapshot of the channel graph for lib_autopilot
+
+The snapshot stores the undirected channel graph in compressed sparse row
+(CSR) form. Nodes are identified by their position in the (sorted) list of
+node ids. For every node i its neighbors are
+
+    targets[offsets[i]:offsets[i + 1]]
+
+and the capacities of the corresponding channels are stored at the same
+positions in capacities. Every channel is therefore stored twice, once for
+each direction. Parallel channels between the same pair of nodes are merged
+into one edge carrying the total capacity and self loops are dropped.
+
+All heuristics of the autopilot read from this snapshot instead of querying
+the networkx graph edge by edge.
+
+Snapshots are stored on disk in a versioned columnar format:
+
+    8 bytes   magic "LNGRAPH\\0"
+    8 bytes   little endian length of the json header
+    header    json with the format version, the type of the node ids and
+              dtype, shape and file offset of every array
+    arrays    flat little endian arrays, each aligned to 64 bytes
+
+The arrays are the CSR offsets, targets and capacities plus the node ids and
+aliases, which are stored as one utf-8 blob each together with int64 offsets
+into the blob. Loading memory-maps the arrays, so only the node ids have to
+be decoded. Pickle files written by older versions of c-lightning-autopilot.py
+can be converted with:
+
+python3 graph_snapshot.py lightning_networkx_graph.pickle lightning_network.snapshot
+'''
+
+from array import array
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+
+SNAPSHOT_MAGIC = b"LNGRAPH\0"
+SNAPSHOT_VERSION = 1
+_ALIGNMENT = 64
+
+
+def _encode_strings(strings):
+    """ encodes a list of strings (or None) as utf-8 blob and offsets """
+    encoded = [(s or "").encode("UTF-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(blob, offsets):
+    raw = blob.tobytes()
+    bounds = offsets.tolist()
+    data = raw.decode("UTF-8")
+    if len(data) != len(raw):
+        # not pure ascii, byte offsets are no character offsets
+        return [raw[bounds[i]:bounds[i + 1]].decode("UTF-8")
+                for i in range(len(bounds) - 1)]
+    return [data[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+
+class GraphSnapshot():
+
+    def __init__(self, nodes, offsets, targets, capacities, aliases=None):
+        """
+        nodes: list of node ids, the position of an id is its index
+        offsets: int64 array of length len(nodes) + 1
+        targets: int64 array of neighbor indices
+        capacities: int64 array of channel capacities in satoshi
+        aliases: optional list of node aliases (None if unknown)
+        """
+        self.nodes = list(nodes)
+        self.offsets = self.__freeze(offsets)
+        self.targets = self.__freeze(targets)
+        self.capacities = self.__freeze(capacities)
+        if aliases is None:
+            aliases = [None] * len(self.nodes)
+        self.aliases = list(aliases)
+        self.__index = None
+        self.__capacity_sums = None
+
+    @staticmethod
+    def __freeze(array):
+        array = np.asarray(array, dtype=np.int64)
+        array.flags.writeable = False
+        return array
+
+    @classmethod
+    def from_edges(cls, nodes, sources, destinations, capacities,
+                   aliases=None):
+        """
+        builds a snapshot from parallel arrays of channel endpoints
+
+        sources and destinations hold node indices. Each channel only needs
+        to be given in one direction.
+        """
+        num_nodes = len(nodes)
+        sources = np.asarray(sources, dtype=np.int64)
+        destinations = np.asarray(destinations, dtype=np.int64)
+        capacities = np.asarray(capacities, dtype=np.int64)
+
+        keep = sources != destinations
+        low = np.minimum(sources, destinations)[keep]
+        high = np.maximum(sources, destinations)[keep]
+        capacities = capacities[keep]
+
+        # merge parallel channels into one edge with the total capacity
+        keys, inverse = np.unique(low * num_nodes + high, return_inverse=True)
+        merged = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(merged, inverse, capacities)
+        low, high = np.divmod(keys, num_nodes)
+
+        rows = np.concatenate([low, high])
+        cols = np.concatenate([high, low])
+        weights = np.concatenate([merged, merged])
+        order = np.lexsort((cols, rows))
+        offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_nodes), out=offsets[1:])
+        return cls(nodes, offsets, cols[order], weights[order], aliases)
+
+    @classmethod
+    def from_networkx(cls, G):
+        """
+        builds a snapshot from a networkx graph with satoshis edge attributes
+
+        nodes are sorted so that the snapshot of the same network does not
+        depend on the order in which nodes were added to G
+        """
+        nodes = sorted(G.nodes())
+        index = {n: i for i, n in enumerate(nodes)}
+        num_edges = G.number_of_edges()
+        sources = np.empty(num_edges, dtype=np.int64)
+        destinations = np.empty(num_edges, dtype=np.int64)
+        capacities = np.empty(num_edges, dtype=np.int64)
+        for i, (n, m, satoshis) in enumerate(G.edges(data="satoshis",
+                                                     default=0)):
+            sources[i] = index[n]
+            destinations[i] = index[m]
+            capacities[i] = satoshis
+        aliases = [G.nodes[n].get("alias") for n in nodes]
+        return cls.from_edges(nodes, sources, destinations, capacities,
+                              aliases)
+
+    @property
+    def num_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def num_edges(self):
+        return len(self.targets) // 2
+
+    @property
+    def index(self):
+        """ dictionary mapping node ids to their index """
+        if self.__index is None:
+            self.__index = {n: i for i, n in enumerate(self.nodes)}
+        return self.__index
+
+    def degrees(self):
+        return np.diff(self.offsets)
+
+    def capacity_sums(self):
+        """ cumulative capacity of all channels of every node """
+        if self.__capacity_sums is None:
+            cumsum = np.concatenate([[0], np.cumsum(self.capacities)])
+            sums = cumsum[self.offsets[1:]] - cumsum[self.offsets[:-1]]
+            sums.flags.writeable = False
+            self.__capacity_sums = sums
+        return self.__capacity_sums
+
+    def neighbors(self, i):
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def adjacency(self):
+        """
+        returns offsets and targets as python lists
+
+        pure python graph traversals index those lists much faster than
+        numpy arrays
+        """
+        return self.offsets.tolist(), self.targets.tolist()
+
+    def edges(self):
+        """ returns sources, destinations and capacities of every edge once """
+        rows = np.repeat(np.arange(self.num_nodes), self.degrees())
+        upper = rows < self.targets
+        return rows[upper], self.targets[upper], self.capacities[upper]
+
+    def neighborhood(self, indices, radius=1):
+        """ indices of all nodes within radius hops of the given nodes """
+        region = set(indices)
+        frontier = list(region)
+        for _ in range(radius):
+            next_frontier = []
+            for i in frontier:
+                for m in self.neighbors(i).tolist():
+                    if m not in region:
+                        region.add(m)
+                        next_frontier.append(m)
+            frontier = next_frontier
+        return np.array(sorted(region), dtype=np.int64)
+
+    def apply_delta(self, added=(), removed=()):
+        """
+        returns a new snapshot with channels added and removed
+
+        channels are (source, destination, satoshis) tuples of node ids. The
+        capacity of a removed channel is subtracted from its edge and edges
+        without remaining capacity are dropped. Unknown nodes of added
+        channels are inserted. As the node list stays sorted indices may
+        shift, so the array mapping every old index to its new index is
+        returned together with the new snapshot.
+        """
+        new_ids = {n for channel in added for n in channel[:2]}
+        new_ids.difference_update(self.index)
+        if new_ids:
+            nodes = sorted(self.nodes + list(new_ids))
+            index = {n: i for i, n in enumerate(nodes)}
+            mapping = np.array([index[n] for n in self.nodes], dtype=np.int64)
+            aliases = [None] * len(nodes)
+            for i, alias in zip(mapping, self.aliases):
+                aliases[i] = alias
+        else:
+            nodes, index, aliases = self.nodes, self.index, self.aliases
+            mapping = np.arange(self.num_nodes, dtype=np.int64)
+
+        sources, destinations, capacities = self.edges()
+        delta = [(index[n], index[m], satoshis)
+                 for n, m, satoshis in added]
+        delta += [(index[n], index[m], -satoshis)
+                  for n, m, satoshis in removed
+                  if n in index and m in index]
+        if delta:
+            delta_sources, delta_destinations, delta_capacities = zip(*delta)
+        else:
+            delta_sources = delta_destinations = delta_capacities = ()
+        sources = np.concatenate([mapping[sources], delta_sources])
+        destinations = np.concatenate([mapping[destinations],
+                                       delta_destinations])
+        capacities = np.concatenate([capacities, delta_capacities])
+
+        low = np.minimum(sources, destinations).astype(np.int64)
+        high = np.maximum(sources, destinations).astype(np.int64)
+        keys, inverse = np.unique(low * len(nodes) + high, return_inverse=True)
+        merged = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(merged, inverse, capacities.astype(np.int64))
+        keep = merged > 0
+        low, high = np.divmod(keys[keep], len(nodes))
+        snapshot = GraphSnapshot.from_edges(nodes, low, high, merged[keep],
+                                            aliases)
+        return snapshot, mapping
+
+    def fingerprint(self):
+        """
+        hash of the node set, the edge set and the capacities
+
+        as nodes are sorted and the CSR arrays are canonical two snapshots
+        of the same network have the same fingerprint
+        """
+        h = hashlib.sha256()
+        h.update("\n".join(str(n) for n in self.nodes).encode())
+        h.update(self.offsets.tobytes())
+        h.update(self.targets.tobytes())
+        h.update(self.capacities.tobytes())
+        return h.hexdigest()
+
+    def nbytes(self):
+        return (self.offsets.nbytes + self.targets.nbytes +
+                self.capacities.nbytes)
+
+    def to_networkx(self):
+        import networkx as nx
+        G = nx.Graph()
+        for n, alias in zip(self.nodes, self.aliases):
+            if alias is None:
+                G.add_node(n)
+            else:
+                G.add_node(n, alias=alias)
+        sources, destinations, capacities = self.edges()
+        G.add_edges_from(
+            (self.nodes[n], self.nodes[m], {"satoshis": satoshis})
+            for n, m, satoshis in zip(sources.tolist(), destinations.tolist(),
+                                      capacities.tolist()))
+        return G
+
+    def save(self, path):
+        """ atomically writes the snapshot in the columnar file format """
+        is_int = all(isinstance(n, (int, np.integer)) for n in self.nodes)
+        node_blob, node_offsets = _encode_strings(str(n) for n in self.nodes)
+        alias_blob, alias_offsets = _encode_strings(self.aliases)
+        arrays = {
+            "offsets": self.offsets,
+            "targets": self.targets,
+            "capacities": self.capacities,
+            "node_blob": node_blob,
+            "node_offsets": node_offsets,
+            "alias_blob": alias_blob,
+            "alias_offsets": alias_offsets,
+        }
+        header = {"version": SNAPSHOT_VERSION,
+                  "node_type": "int" if is_int else "str",
+                  "arrays": {}}
+        # offsets depend on the header length, so lay out with a
+        # generously padded header first
+        position = 0
+        for name, a in arrays.items():
+            header["arrays"][name] = {"dtype": a.dtype.newbyteorder("<").str,
+                                      "shape": list(a.shape),
+                                      "offset": position}
+            position += -(-a.nbytes // _ALIGNMENT) * _ALIGNMENT
+        start = 16 + len(json.dumps(header)) + 20 * len(arrays)
+        start = -(-start // _ALIGNMENT) * _ALIGNMENT
+        for entry in header["arrays"].values():
+            entry["offset"] += start
+        encoded = json.dumps(header).encode("UTF-8")
+        assert 16 + len(encoded) <= start
+
+        tmppath = path + ".tmp"
+        with open(tmppath, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack("<Q", len(encoded)))
+            f.write(encoded)
+            for name, a in arrays.items():
+                f.seek(header["arrays"][name]["offset"])
+                f.write(np.ascontiguousarray(a, a.dtype.newbyteorder("<"))
+                        .tobytes())
+            f.truncate()
+        os.rename(tmppath, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        reads a snapshot file, memory-mapping its arrays unless mmap is False
+
+        raises ValueError if the file is not a snapshot or has an unknown
+        version
+        """
+        with open(path, "rb") as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError("{} is not a graph snapshot".format(path))
+            length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(length).decode("UTF-8"))
+        if header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("unsupported snapshot version {} in {}".format(
+                header.get("version"), path))
+
+        arrays = {}
+        for name, entry in header["arrays"].items():
+            shape = tuple(entry["shape"])
+            if mmap and np.prod(shape) > 0:
+                arrays[name] = np.memmap(path, dtype=entry["dtype"], mode="r",
+                                         offset=entry["offset"], shape=shape)
+            else:
+                with open(path, "rb") as f:
+                    f.seek(entry["offset"])
+                    arrays[name] = np.fromfile(f, dtype=entry["dtype"],
+                                               count=int(np.prod(shape)))
+
+        nodes = _decode_strings(arrays["node_blob"], arrays["node_offsets"])
+        if header["node_type"] == "int":
+            nodes = [int(n) for n in nodes]
+        aliases = [a or None for a in _decode_strings(arrays["alias_blob"],
+                                                      arrays["alias_offsets"])]
+        return cls(nodes, arrays["offsets"], arrays["targets"],
+                   arrays["capacities"], aliases)
+
+
+class SnapshotBuilder():
+    """
+    collects nodes and channels one by one and builds a GraphSnapshot
+
+    channels are stored in typed arrays right away, so no networkx graph and
+    no list of channel dictionaries has to be held in memory. As listchannels
+    returns every channel once per direction, channels are deduplicated by
+    their short_channel_id.
+    """
+
+    def __init__(self):
+        self.__index = {}
+        self.__aliases = []
+        self.__seen = set()
+        self.__sources = array("q")
+        self.__destinations = array("q")
+        self.__capacities = array("q")
+
+    def __node(self, node_id):
+        i = self.__index.get(node_id)
+        if i is None:
+            i = self.__index[node_id] = len(self.__aliases)
+            self.__aliases.append(None)
+        return i
+
+    def add_node(self, node_id, alias=None):
+        i = self.__node(node_id)
+        if alias:
+            self.__aliases[i] = alias
+
+    def add_channel(self, short_channel_id, source, destination, satoshis):
+        """ returns False if the channel was already added """
+        if short_channel_id in self.__seen:
+            return False
+        self.__seen.add(short_channel_id)
+        self.__sources.append(self.__node(source))
+        self.__destinations.append(self.__node(destination))
+        self.__capacities.append(satoshis)
+        return True
+
+    @property
+    def num_nodes(self):
+        return len(self.__aliases)
+
+    @property
+    def num_channels(self):
+        return len(self.__capacities)
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (
+            self.__sources, self.__destinations, self.__capacities))
+
+    def build(self):
+        nodes = sorted(self.__index)
+        mapping = np.empty(len(nodes), dtype=np.int64)
+        for i, node_id in enumerate(nodes):
+            mapping[self.__index[node_id]] = i
+        aliases = [self.__aliases[self.__index[n]] for n in nodes]
+        sources = mapping[np.frombuffer(self.__sources, dtype=np.int64)]
+        destinations = mapping[np.frombuffer(self.__destinations,
+                                             dtype=np.int64)]
+        capacities = np.frombuffer(self.__capacities, dtype=np.int64)
+        return GraphSnapshot.from_edges(nodes, sources, destinations,
+                                        capacities, aliases)
+
+
+def load_graph_file(path):
+    """
+    loads a GraphSnapshot from a snapshot file or a legacy pickle file
+
+    pickle files may contain a networkx graph or a GraphSnapshot
+    """
+    try:
+        return GraphSnapshot.load(path)
+    except ValueError:
+        with open(path, "rb") as infile:
+            graph = pickle.load(infile)
+        if isinstance(graph, GraphSnapshot):
+            return graph
+        return GraphSnapshot.from_networkx(graph)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="converts a pickled network into a graph snapshot")
+    parser.add_argument("input", help="points to a pickle file")
+    parser.add_argument("output", help="path of the snapshot file to write")
+    args = parser.parse_args()
+
+    snapshot = load_graph_file(args.input)
+    snapshot.save(args.output)
+    print("Wrote snapshot with {} nodes and {} edges to {}".format(
+        snapshot.num_nodes, snapshot.num_edges, args.output))
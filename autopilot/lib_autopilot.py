@@ -16,7 +16,9 @@ The library also estimates how much funds should be used for every newly
 added channel. This is achieved by looking at the average channel capacity
 of the suggested channel partners. A probability distribution which is 
 proportional to those capacities is created and smoothed with the uniform
-distribution. 
+distribution. The balance is split according to this distribution while
+every channel gets at least 20k satoshi and optionally no more than a share
+of the capacity of the destination node.
 
 The 4 heuristics for channel partner suggestion are: 
 
@@ -29,10 +31,10 @@ favors badly connected nodes
 4.) Richness: nodes with high liquidity are taken and it is sampled from a 
 uniform distribution of those
 
-The library is supposed to be extended by a simulation framework which can 
-be used to evaluate which strategies are useful on the long term. For this
-heavy computations (like centrality measures) might have to be reimplemented
-in a more dynamic way. 
+The simulation framework in simulation.py can be used to evaluate which 
+strategies are useful on the long term. It lets nodes join a network one 
+after another and updates the heuristics incrementally with 
+Autopilot.update_channels instead of recomputing them from scratch.
 
 Also it is important to understand that this program is not optimized to run
 efficiently on large scale graphs with more than 100k nodes or on densly 
@@ -48,10 +50,7 @@ ideas:
 * include more statistics of the network:
 * allow autopilots of various nodes to exchange some information
 * exchange algorithms if the network grows.
-* include better handling for duplicates and existing channels
 * cap number of channels for well connected nodes.
-* channel balance of automatic channels should not be more than 50% of 
-cummulative channel balance of destination node
 
 
 next steps: 
@@ -59,25 +58,356 @@ next steps:
 * evaluate / simulate which method produces graphs with desirable properties
 """
 
-from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import logging
 import math
 import pickle
 
 
-import networkx as nx
 import numpy as np
 
+from graph_snapshot import GraphSnapshot
+
 class Strategy:
     #define constants. Never changed as they are part of the API
     DIVERSE = "diverse"
     MERGE = "merge"    
 
+def centrality_error_bound(num_nodes, samples, delta=0.1):
+    """
+    upper bound for the absolute error of sampled betweenness centrality
+
+    Using pivot sampling (Brandes & Pich) every sampled source contributes
+    a dependency score which lies in [0, 1] after normalization. By
+    Hoeffding's inequality and a union bound over all nodes the estimate of
+    every node is within the returned epsilon of the exact normalized score
+    with probability of at least 1 - delta.
+    """
+    if samples is None or samples >= num_nodes:
+        return 0.0
+    return math.sqrt(math.log(2 * num_nodes / delta) / (2 * samples))
+
+
+# CSR adjacency (offsets, targets) of the graph processed by the workers
+_worker_adjacency = None
+
+
+def _init_worker(adjacency):
+    global _worker_adjacency
+    _worker_adjacency = adjacency
+
+
+def _accumulate_distances(sources, adjacency=None, source_sums=None):
+    """
+    sums the hop distances of breadth first searches from several sources
+
+    the adjacency is a tuple of CSR offsets and targets as python lists. The
+    result holds for every node the sum of its distances to all given
+    sources. Only one distance array per search is kept in memory at any time.
+    If a dictionary source_sums is given the total distance of every source
+    to all nodes is stored in it
+    """
+    offsets, targets = adjacency or _worker_adjacency
+    num_nodes = len(offsets) - 1
+    totals = np.zeros(num_nodes, dtype=np.float64)
+    for source in sources:
+        distances = [-1] * num_nodes
+        distances[source] = 0
+        frontier = [source]
+        depth = 0
+        while frontier:
+            depth += 1
+            next_frontier = []
+            for n in frontier:
+                for j in range(offsets[n], offsets[n + 1]):
+                    m = targets[j]
+                    if distances[m] < 0:
+                        distances[m] = depth
+                        next_frontier.append(m)
+            frontier = next_frontier
+        row = np.array(distances, dtype=np.float64)
+        row[row < 0] = 0
+        totals += row
+        if source_sums is not None:
+            source_sums[source] = row.sum()
+    return totals
+
+
+def _accumulate_dependencies(sources, adjacency=None):
+    """
+    sums the dependencies of Brandes' algorithm for several sources
+
+    predecessors are not stored but recovered in the backward pass by
+    looking for neighbors which are one hop closer to the source
+    """
+    offsets, targets = adjacency or _worker_adjacency
+    num_nodes = len(offsets) - 1
+    betweenness = [0.0] * num_nodes
+    for source in sources:
+        sigma = [0] * num_nodes
+        distances = [-1] * num_nodes
+        sigma[source] = 1
+        distances[source] = 0
+        order = [source]
+        i = 0
+        while i < len(order):
+            v = order[i]
+            i += 1
+            next_distance = distances[v] + 1
+            for j in range(offsets[v], offsets[v + 1]):
+                w = targets[j]
+                if distances[w] < 0:
+                    distances[w] = next_distance
+                    order.append(w)
+                if distances[w] == next_distance:
+                    sigma[w] += sigma[v]
+
+        delta = [0.0] * num_nodes
+        for w in reversed(order):
+            coefficient = (1 + delta[w]) / sigma[w]
+            previous_distance = distances[w] - 1
+            for j in range(offsets[w], offsets[w + 1]):
+                v = targets[j]
+                if distances[v] == previous_distance:
+                    delta[v] += sigma[v] * coefficient
+            if w != source:
+                betweenness[w] += delta[w]
+    return np.array(betweenness, dtype=np.float64)
+
+
+def _spread_sources(accumulate, adjacency, sources, workers=1,
+                    executor=None):
+    """
+    runs accumulate on chunks of sources and sums the partial results
+
+    with more than one worker the chunks are processed by a process pool.
+    If an executor is given its workers must have been initialized with the
+    same adjacency by _init_worker
+    """
+    if workers <= 1 or len(sources) <= workers:
+        return accumulate(sources, adjacency)
+
+    chunks = np.array_split(sources, 4 * workers)
+    totals = np.zeros(len(adjacency[0]) - 1, dtype=np.float64)
+    if executor is not None:
+        for partial in executor.map(accumulate, chunks):
+            totals += partial
+        return totals
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(adjacency,)) as executor:
+        for partial in executor.map(accumulate, chunks):
+            totals += partial
+    return totals
+
+
+def _sample_sources(num_nodes, samples=None, rng=None):
+    if samples is None or samples >= num_nodes:
+        return np.arange(num_nodes)
+    if rng is None:
+        rng = np.random.default_rng()
+    return rng.choice(num_nodes, samples, replace=False)
+
+
+def approximate_betweenness(snapshot, samples=None, workers=1, executor=None,
+                            rng=None):
+    """
+    computes the betweenness centrality of all nodes of a GraphSnapshot
+
+    if samples is None or not smaller than the number of nodes the exact
+    scores are computed. Otherwise only samples source nodes are used as
+    pivots which reduces the run time from O(V*E) to O(samples*E). The
+    scores are normalized like nx.betweenness_centrality and returned as a
+    vector together with the error bound of centrality_error_bound
+    """
+    num_nodes = snapshot.num_nodes
+    sources = _sample_sources(num_nodes, samples, rng)
+    scores = _spread_sources(_accumulate_dependencies, snapshot.adjacency(),
+                             sources, workers, executor)
+    if num_nodes > 2:
+        scores *= num_nodes / len(sources) / ((num_nodes - 1) * (num_nodes - 2))
+    return scores, centrality_error_bound(num_nodes, samples)
+
+
+def path_length_sums(snapshot, samples=None, workers=1, executor=None,
+                     rng=None):
+    """
+    computes for every node the sum of shortest path lengths to all nodes
+
+    the sums are returned as a vector in the node order of the snapshot
+
+    In opposite to nx.shortest_path_length the lengths are streamed from one
+    breadth first search per source into a single accumulator so memory stays
+    in O(V) per worker. As the graph is undirected the sum of the distances
+    of one node to all sources equals the contribution of those sources to
+    its path length sum. If samples is set only this number of sources is
+    drawn and the sums are scaled up accordingly. With more than one worker
+    the sources are spread over a process pool
+    """
+    num_nodes = snapshot.num_nodes
+    sources = _sample_sources(num_nodes, samples, rng)
+    totals = _spread_sources(_accumulate_distances, snapshot.adjacency(),
+                             sources, workers, executor)
+    totals *= num_nodes / len(sources)
+    return totals
+
+
+def top_mass(pdf, percentile):
+    """
+    the most likely entries of pdf up to the first one exceeding percentile
+
+    returns their indices in descending order of probability together with
+    their total probability. Instead of sorting the whole pdf the largest
+    entries are selected with argpartition, starting with a small candidate
+    set that grows until it carries enough mass. Only this set is sorted.
+    """
+    num_items = len(pdf)
+    m = min(num_items, 64)
+    while True:
+        top = np.argpartition(pdf, num_items - m)[num_items - m:]
+        if m == num_items or pdf[top].sum() > percentile:
+            break
+        m = min(num_items, 4 * m)
+    top = top[np.argsort(pdf[top])[::-1]]
+    cumsum = np.cumsum(pdf[top])
+    cut = min(np.searchsorted(cumsum, percentile, side="right") + 1, len(top))
+    return top[:cut], cumsum[cut - 1]
+
+
+class WeightedSampler():
+    """
+    draws indices without replacement with probabilities proportional to
+    weights in O(k log n)
+
+    the weights are stored in a Fenwick tree (binary indexed tree) of partial
+    sums. A draw descends the tree in O(log n) and removes the weight of the
+    drawn index from the tree. After every call of sample the removed weights
+    are added back, so one sampler is built once per distribution and reused
+    for every draw.
+    """
+
+    def __init__(self, weights, rng):
+        weights = np.asarray(weights, dtype=np.float64)
+        self.__rng = rng
+        self.__size = len(weights)
+        self.__weights = weights.tolist()
+        prefix = np.concatenate([[0.0], np.cumsum(weights)])
+        positions = np.arange(1, self.__size + 1)
+        lowbit = positions & -positions
+        self.__tree = [0.0] + (prefix[positions] -
+                               prefix[positions - lowbit]).tolist()
+        self.__total = float(prefix[-1])
+        self.__top_bit = 1 << max(self.__size.bit_length() - 1, 0)
+
+    def __add(self, i, value):
+        i += 1
+        while i <= self.__size:
+            self.__tree[i] += value
+            i += i & -i
+
+    def __find(self, u):
+        """ smallest index whose prefix sum exceeds u """
+        tree = self.__tree
+        pos = 0
+        step = self.__top_bit
+        while step:
+            nxt = pos + step
+            if nxt <= self.__size and tree[nxt] <= u:
+                pos = nxt
+                u -= tree[nxt]
+            step >>= 1
+        return pos
+
+    def sample(self, k, exclude=()):
+        """
+        draws up to k distinct indices, never one of the excluded indices
+
+        fewer than k indices are returned if the remaining weights are zero
+        """
+        removed = {}
+
+        def remove(i):
+            removed[i] = self.__weights[i]
+            self.__add(i, -self.__weights[i])
+            self.__weights[i] = 0.0
+
+        for i in exclude:
+            if i not in removed:
+                remove(i)
+        total = self.__total - sum(removed.values())
+
+        drawn = []
+        while len(drawn) < k and total > 1e-12 * self.__total:
+            i = self.__find(self.__rng.random() * total)
+            if i >= self.__size or self.__weights[i] <= 0:
+                # rounding errors of the partial sums, fall back to the
+                # largest remaining weight
+                i = int(np.argmax(self.__weights))
+                if self.__weights[i] <= 0:
+                    break
+            total -= self.__weights[i]
+            drawn.append(i)
+            remove(i)
+
+        for i, weight in removed.items():
+            self.__weights[i] = weight
+            self.__add(i, weight)
+        return np.array(drawn, dtype=np.int64)
+
+
 class Autopilot():
 
-    def __init__(self, G):
+    def __init__(self, G, centrality_samples=None, path_samples=None,
+                 workers=1, cache=None, staleness_threshold=0.05, seed=None):
+        """
+        centrality_samples: if set only this number of source nodes is
+        sampled to approximate the betweenness centrality. None computes
+        the exact scores
+
+        path_samples: if set only this number of source nodes is used to
+        estimate the path length sums of the decrease diameter heuristic
+
+        workers: number of processes among which the breadth first searches
+        of the decrease diameter and the centrality heuristic are spread
+
+        cache: optional ScoreCache which persists the heuristic scores
+
+        staleness_threshold: fraction of channels which may change through
+        update_channels before all scores are recomputed from scratch
+
+        seed: seed of the random number generators used for all sampling, set
+        it to get reproducible candidates. The sources of the path and
+        centrality heuristics and the candidates are drawn from three
+        independent generators, so cached scores or parallel workers don't
+        change the candidates
+
+        G can either be a networkx graph or a GraphSnapshot. A networkx graph
+        is converted once into a snapshot from which all heuristics read
+        """
         self.__add_logger()        
-        self.G = G
+        if isinstance(G, GraphSnapshot):
+            self.G = None
+            self.snapshot = G
+        else:
+            self.G = G
+            self.snapshot = GraphSnapshot.from_networkx(G)
+        # every pdf is a float64 vector indexed by the position of a node in
+        # this list
+        self.__nodes = self.snapshot.nodes
+        self.centrality_samples = centrality_samples
+        self.path_samples = path_samples
+        self.workers = workers
+        self.cache = cache
+        self.staleness_threshold = staleness_threshold
+        self.seed = seed
+        path_seed, centrality_seed, candidate_seed = \
+            np.random.SeedSequence(seed).spawn(3)
+        self.__path_rng = np.random.default_rng(path_seed)
+        self.__centrality_rng = np.random.default_rng(centrality_seed)
+        self.rng = np.random.default_rng(candidate_seed)
+        self.__scores = None
+        self.__pdfs = None
+        self.__samplers = {}
+        self.__changed_channels = 0
 
     def __add_logger(self):
         """ initiates the logging service for this class """
@@ -91,44 +421,55 @@ class Autopilot():
         ch.setFormatter(formatter)
         self.__logger.addHandler(ch)
 
-    def __sample_from_pdf(self,pdf,k=21):
+    def __sample_from_pdf(self, sampler, k=21, exclude=()):
         """
-        helper function to quickly sample from a pdf encoded in a dictionary
+        helper function to quickly sample node indices with a WeightedSampler
         """
         if type(k) is not int:
             raise TypeError("__sample_from: k must be an integer variable")
         if k < 0 or k > 21000:
             raise ValueError("__sample_from: k must be between 0 and 21000")
         
-        keys,v = zip(*list(pdf.items()))
-        if k>=len(keys):
-            return keys
-        res = np.random.choice(keys, k, replace=False, p=v)
-        return res
+        return sampler.sample(k, exclude)
     
-    def __sample_from_percentile(self, pdf, percentile=0.5, num_items=21):
+    def __sample_from_percentile(self, name, pdf, percentile=0.5,
+                                 num_items=21, exclude=(), mask=None):
         """
         only look at the most likely items and sample from those
+
+        nodes of the exclusion index mask are removed from the pdf before
+        the most likely items are selected. The sampler of every pdf,
+        percentile and mask is built once and reused until the scores
+        change. Nodes in exclude are never drawn either
         """
-        if not percentile:
-            return self.__sample_from_pdf(pdf,num_items)
+        if percentile:
+            if type(percentile) is not float:
+                raise TypeError("percentile must be a floating point variable")
+            if percentile < 0 or percentile > 1:
+                raise ValueError("percentile must be btween 0 and 1")
 
-        if type(percentile) is not float:
-            raise TypeError("percentile must be a floating point variable")
-        if percentile < 0 or percentile > 1:
-            raise ValueError("percentile must be btween 0 and 1")
-                
-        cumsum = 0
-        used_pdf = {}
-        for n, value in sorted(
-                pdf.items(), key=itemgetter(1), reverse=True):
-            cumsum += value
-            used_pdf[n] = value
-            if cumsum > percentile:
-                break
-            
-        used_pdf = {k:v/cumsum for k, v in used_pdf.items()}
-        return self.__sample_from_pdf(used_pdf, num_items)
+        mask_key = None
+        if mask is not None and len(mask):
+            mask_key = mask.tobytes()
+        key = (name, percentile or None, mask_key)
+        if key not in self.__samplers:
+            if mask_key is not None:
+                pdf = pdf.copy()
+                pdf[mask] = 0.0
+                if pdf.sum() > 0:
+                    pdf /= pdf.sum()
+            if percentile:
+                top, _ = top_mass(pdf, percentile)
+                self.__samplers[key] = (top, WeightedSampler(pdf[top],
+                                                             self.rng))
+            else:
+                self.__samplers[key] = (None, WeightedSampler(pdf, self.rng))
+        top, sampler = self.__samplers[key]
+
+        if top is None:
+            return self.__sample_from_pdf(sampler, num_items, exclude)
+        local_exclude = np.flatnonzero(np.isin(top, exclude))
+        return top[self.__sample_from_pdf(sampler, num_items, local_exclude)]
        
     def __get_uniform_pdf(self):
         """
@@ -138,9 +479,8 @@ class Autopilot():
         or skewing since this would not do anything to the uniform
         distribution
         """
-        pdf = {n:1 for n in self.G.nodes()}
-        length = len(pdf)
-        return {k:v/length for k, v in pdf.items()}
+        length = len(self.__nodes)
+        return np.full(length, 1 / length)
         
     def __get_centrality_pdf(self, skew = False, smooth = False):
         """
@@ -151,18 +491,15 @@ class Autopilot():
         however it is good for the node operating those operation as this node
         itself gets a position in the network which is close to central nodes
         
-        this distribution can be skewed and smoothed
+        this distribution can be skewed and smoothed. If the autopilot was
+        created with centrality_samples the scores are approximated by
+        sampling source nodes
         """
         self.__logger.info(
             "CENTRALITY_PDF: Try to generate a PDF proportional to centrality scores")
-        pdf = {}
-        cumsum = 0
-        for n, score in nx.betweenness_centrality(self.G).items():
-            pdf[n] = score
-            cumsum += score
-            
+        scores = self.__get_scores()["centrality"]
         #renoremalize result
-        pdf = {k:v/cumsum for k, v in pdf.items()}
+        pdf = scores / scores.sum()
         self.__logger.info(
             "CENTRALITY_PDF: Generated pdf")
         
@@ -190,17 +527,8 @@ class Autopilot():
         self.__logger.info(
             "RICH_PDF: Try to retrieve a PDF proportional to capacities")
 
-        rich_nodes = {}
-        network_capacity = 0
-        candidates = []
-        for n in self.G.nodes():
-            total_capacity = sum(
-                self.G.get_edge_data(
-                    n, m)["satoshis"] for m in self.G.neighbors(n))
-            network_capacity += total_capacity
-            rich_nodes[n] = total_capacity
-
-        rich_nodes = {k:v/network_capacity for k, v in rich_nodes.items()}
+        scores = self.__get_scores()["rich"]
+        rich_nodes = scores / scores.sum()
 
         self.__logger.info(
             "RICH_PDF: Generated a PDF proportional to capacities")
@@ -223,6 +551,10 @@ class Autopilot():
         path lenghts for each node and derives the a probability distribution
         from the sums. The idea of this method is to find nodes which are 
         increasing the diameter of the network.
+
+        The sums are computed by path_length_sums which streams one breadth
+        first search per source and can sample sources (path_samples) and
+        spread them over several processes (workers)
         
         The method will by default skew the pdf by taking the squares of the
         sums of path lengths before deriving a pdf. If one whishes the method
@@ -236,18 +568,11 @@ class Autopilot():
             "DECREASE DIAMETER: Can't skew and smooth distribution ignore smoothing")
             smooth = False
                 
-        path_pdf = {}
         self.__logger.info(
             "DECREASE DIAMETER: Generating probability density function")
 
-        all_pair_shortest_path_lengths = nx.shortest_path_length(self.G)
-
-        for node, paths in all_pair_shortest_path_lengths:
-            path_sum = sum(length for _, length in paths.items())
-            path_pdf[node] = path_sum
-        
-        s = sum(path_pdf.values())
-        path_pdf = {k:v/s for k,v in path_pdf.items()}
+        scores = self.__get_scores()["path"]
+        path_pdf = scores / scores.sum()
         self.__logger.info(
             "DECREASE DIAMETER: probability density function created")
 
@@ -274,28 +599,195 @@ class Autopilot():
         if skew:
             self.__logger.info(
             "manipulate_pdf: Skewing the probability density function")
-            pdf = {k:v**2 for k,v in pdf.items()}
-            s = sum(pdf.values())
-            pdf = {k:v/s for k,v in pdf.items()}
+            pdf = np.square(pdf)
+            pdf /= pdf.sum()
         
         if smooth:
             self.__logger.info(
             "manipulate_pdf: Smoothing the probability density function")
-            pdf = {k:0.5*v + 0.5/length for k,v in pdf.items()}
+            pdf = 0.5 * pdf + 0.5 / length
             
         return pdf
 
+    def __get_centrality_scores(self, executor=None):
+        scores, error_bound = approximate_betweenness(
+            self.snapshot, self.centrality_samples, self.workers, executor,
+            self.__centrality_rng)
+        if error_bound > 0:
+            self.__logger.info(
+            "CENTRALITY_PDF: Approximated scores with {} sampled sources. Absolute error of normalized scores is below {:.4f} with 90% probability".format(
+                self.centrality_samples, error_bound))
+        return scores
+
+    def __get_path_scores(self, executor=None):
+        if self.path_samples is not None:
+            self.__logger.info(
+            "DECREASE DIAMETER: Estimate path length sums from {} sampled sources".format(
+                self.path_samples))
+        return path_length_sums(self.snapshot, self.path_samples,
+                                self.workers, executor, self.__path_rng)
+
+    def __compute_scores(self):
+        """
+        computes the raw scores of the path, centrality and rich heuristics
+
+        with more than one worker one process pool is created which shares
+        the read only adjacency of the snapshot. The path and centrality
+        heuristics are driven by two threads which both split their sources
+        into chunks for this pool, so the chunks of both heuristics are
+        processed at the same time
+        """
+        rich = self.snapshot.capacity_sums().astype(np.float64)
+        if self.workers <= 1:
+            return {
+                "path": self.__get_path_scores(),
+                "centrality": self.__get_centrality_scores(),
+                "rich": rich,
+            }
+
+        self.__logger.info(
+            "Compute heuristics with {} worker processes".format(self.workers))
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                 initargs=(self.snapshot.adjacency(),)
+                                 ) as processes:
+            with ThreadPoolExecutor(2) as threads:
+                path = threads.submit(self.__get_path_scores, processes)
+                centrality = threads.submit(self.__get_centrality_scores,
+                                            processes)
+                return {
+                    "path": path.result(),
+                    "centrality": centrality.result(),
+                    "rich": rich,
+                }
+
+    def __set_scores(self, scores):
+        """ replaces the scores and drops the pdfs and samplers built on them """
+        self.__scores = scores
+        self.__pdfs = None
+        self.__samplers = {}
+
+    def __get_scores(self):
+        """
+        returns the raw scores of the path, centrality and rich heuristics
+
+        the scores are computed only once per autopilot. If a ScoreCache was
+        given they are looked up by the fingerprint of the graph and the
+        sampling settings (including the seed if sources are sampled) before
+        computing them
+        """
+        if self.__scores is not None:
+            return self.__scores
+
+        key = "{}-c{}-p{}".format(self.snapshot.fingerprint(),
+                                  self.centrality_samples, self.path_samples)
+        sampled = self.centrality_samples is not None or \
+            self.path_samples is not None
+        if sampled and self.seed is not None:
+            key += "-s{}".format(self.seed)
+        if self.cache is not None:
+            self.__set_scores(self.cache.load(key))
+            if self.__scores is not None:
+                self.__logger.info(
+                    "Loaded heuristic scores from cache: {}".format(key))
+                return self.__scores
+
+        self.__changed_channels = 0
+        self.__set_scores(self.__compute_scores())
+        if self.cache is not None:
+            self.cache.store(key, self.__scores)
+            self.__logger.info(
+                "Stored heuristic scores in cache: {}".format(key))
+        return self.__scores
+
+    def update_channels(self, added=(), removed=(), radius=1):
+        """
+        updates the graph and the heuristic scores from gossip deltas
+
+        channels are given as (source, destination, satoshis) tuples. The
+        capacity sums are updated exactly. For the path and centrality scores
+        only the affected region, all nodes within radius hops of the changed
+        channels, is recomputed: the distances and dependencies of the region
+        as sources are replaced by their values on the new graph. Pairs of
+        nodes outside of the region keep their old contribution, which is why
+        the scores become stale over time. Once more than staleness_threshold
+        of all channels changed since the last full computation (or the region
+        is larger than a full computation) the scores are dropped and will be
+        recomputed on the next call of find_candidates.
+
+        self.G is not modified, the snapshot is the only graph kept current
+        """
+        old = self.snapshot
+        new, mapping = old.apply_delta(added, removed)
+        self.snapshot = new
+        self.__nodes = new.nodes
+        self.__changed_channels += len(added) + len(removed)
+        self.__logger.info(
+            "UPDATE: Applied {} added and {} removed channels".format(
+                len(added), len(removed)))
+        if self.__scores is None:
+            return
+
+        endpoints = [new.index[n] for channel in list(added) + list(removed)
+                     for n in channel[:2] if n in new.index]
+        region = new.neighborhood(endpoints, radius)
+        # the same nodes as sources on the old graph, new nodes have no past
+        old_region = [old.index[new.nodes[i]] for i in region
+                      if new.nodes[i] in old.index]
+        full_sources = min(new.num_nodes, self.path_samples or new.num_nodes,
+                           self.centrality_samples or new.num_nodes)
+        if (self.__changed_channels > self.staleness_threshold * new.num_edges
+                or len(region) >= full_sources):
+            self.__logger.info(
+                "UPDATE: {} changed channels since the last full computation. Scores will be recomputed".format(
+                    self.__changed_channels))
+            self.__set_scores(None)
+            self.__changed_channels = 0
+            return
+
+        self.__logger.info(
+            "UPDATE: Recompute path and centrality scores of {} affected nodes".format(
+                len(region)))
+
+        def remap(vector):
+            result = np.zeros(new.num_nodes, dtype=np.float64)
+            result[mapping] = vector
+            return result
+
+        scores = {name: remap(v) for name, v in self.__scores.items()}
+        scores["rich"] = new.capacity_sums().astype(np.float64)
+
+        old_adjacency = old.adjacency()
+        new_adjacency = new.adjacency()
+
+        region_sums = {}
+        scores["path"] += _accumulate_distances(region, new_adjacency,
+                                                region_sums)
+        scores["path"] -= remap(_accumulate_distances(old_region,
+                                                      old_adjacency))
+        for i, total in region_sums.items():
+            scores["path"][i] = total
+
+        n = new.num_nodes
+        if n > 2:
+            delta = _accumulate_dependencies(region, new_adjacency)
+            delta -= remap(_accumulate_dependencies(old_region, old_adjacency))
+            scores["centrality"] += delta / ((n - 1) * (n - 2))
+            np.clip(scores["centrality"], 0, None, out=scores["centrality"])
+        self.__set_scores(scores)
+
     def __create_pdfs(self):
+        if self.__pdfs is not None:
+            return self.__pdfs
         res = {}
         res["path"] = self.__get_long_path_pdf()
         res["centrality"] = self.__get_centrality_pdf()
         res["rich"] = self.__get_rich_nodes_pdf()
         res["uniform"] = self.__get_uniform_pdf()
+        self.__pdfs = res
         return res
-        
 
 
-    def calculate_statistics(self, candidates):
+    def calculate_statistics(self, candidates, verbose=True):
         """
         computes statistics of the candidate set about connectivity, wealth 
         and returns a probability density function (pdf) which encodes which 
@@ -306,82 +798,146 @@ class Autopilot():
         smoothed with a uniform distribution currently the smoothing is just a
          weighted arithmetic mean with a weight of 0.3 for the uniform 
          distribution.
+
+        with verbose the statistics are printed as a table
         """
-        pdf = {}
-        for candidate in candidates:
-            neighbors = list(self.G.neighbors(candidate))
-            capacity = sum([self.G.get_edge_data(candidate, n)
-                            ["satoshis"] for n in neighbors])
-            average = capacity / (1+len(neighbors))
-            pdf[candidate] = average
-        cumsum = sum(pdf.values())
-        pdf = {k: v / cumsum for k, v in pdf.items()}
+        index = self.snapshot.index
+        positions = np.array([index[c] for c in candidates], dtype=np.int64)
+        capacities = self.snapshot.capacity_sums()[positions]
+        degrees = self.snapshot.degrees()[positions]
+        pdf = capacities / (1 + degrees)
+        pdf = pdf / pdf.sum()
         w = 0.7
-        print("percentage   smoothed percentage    capacity    numchannels     alias")
-        print("----------------------------------------------------------------------")
+        if verbose:
+            print("percentage   smoothed percentage    capacity    numchannels     alias")
+            print("----------------------------------------------------------------------")
         res_pdf = {}
-        for k, v in pdf.items():
-            neighbors = list(self.G.neighbors(k))
-            capacity = sum([self.G.get_edge_data(k, n)["satoshis"]
-                            for n in neighbors])
-            name = k
-            if "alias" in self.G.node[k]:
-                name = self.G.node[k]["alias"]
-            print("{:12.2f}  ".format(100 * v),
-                  "{:12.2f}     ".format(
-                      100 * (w * v + (1 - w) / len(candidates))),
-                  "{:10} {:10}     ".format(capacity,
-                                            len(neighbors)),
-                  name)
+        for i, k in enumerate(candidates):
+            v = pdf[i]
+            name = self.snapshot.aliases[positions[i]] or k
+            if verbose:
+                print("{:12.2f}  ".format(100 * v),
+                      "{:12.2f}     ".format(
+                          100 * (w * v + (1 - w) / len(candidates))),
+                      "{:10} {:10}     ".format(capacities[i],
+                                                degrees[i]),
+                      name)
             res_pdf[k] = (w * v + (1 - w) / len(candidates))
         return res_pdf
 
-    def calculate_proposed_channel_capacities(self, pdf, balance=1000000):
+    def calculate_proposed_channel_capacities(self, pdf, balance=1000000,
+                                              max_share=None, caps=None):
+        """
+        splits balance among the candidates of pdf and returns the amount in
+        satoshi for each channel
+
+        every channel gets at least minimal_channel_balance satoshi. If the
+        balance does not suffice for all candidates the least likely ones are
+        dropped. Candidates are sorted once by probability and the largest
+        feasible prefix is found with a binary search (feasibility is monotone
+        since adding a candidate never increases the share of the others).
+
+        channels can be capped: with max_share no channel is larger than this
+        fraction of the total capacity of the destination node and caps maps
+        nodes to a maximal amount in satoshi. Funds above the cap of a node
+        are spread over the uncapped ones in proportion to their
+        probabilities. Candidates whose cap is below the minimal channel
+        balance are dropped.
+        """
         minimal_channel_balance = 20000  # lnd uses 20k satoshi which seems reasonble
 
-        min_probability = min(pdf.values())
-        needed_total_balance = math.ceil(
-            minimal_channel_balance / min_probability)
-        self.__logger.info(
-            "Need at least a balance of {} satoshi to open {} channels".format(
-                needed_total_balance, len(pdf)))
-        while needed_total_balance > balance and len(pdf) > 1:
-            min_val = min(pdf.values())
-            k = [k for k, v in pdf.items() if v == min_val][0]
+        limits = {}
+        if max_share is not None:
+            index = self.snapshot.index
+            capacities = self.snapshot.capacity_sums()
+            for k in pdf:
+                if k in index:
+                    limits[k] = max_share * capacities[index[k]]
+        for k, cap in (caps or {}).items():
+            if k in pdf:
+                limits[k] = min(cap, limits.get(k, cap))
+
+        nodes = [k for k in pdf
+                 if pdf[k] > 0 and limits.get(k, balance) >= minimal_channel_balance]
+        if len(nodes) < len(pdf):
             self.__logger.info(
-                "Not enough balance to open {} channels. Remove node: {} and rebalance pdf for channel balances".format(
-                    len(pdf), k))
-            del pdf[k]
+                "Drop {} candidates with a cap below {} satoshi".format(
+                    len(pdf) - len(nodes), minimal_channel_balance))
+        nodes.sort(key=lambda k: pdf[k], reverse=True)
+        # the order in which nodes hit their cap while the funds per unit of
+        # probability grow
+        by_ratio = sorted(range(len(nodes)),
+                          key=lambda i: limits.get(nodes[i], math.inf) / pdf[nodes[i]])
+
+        def allocate(num_nodes):
+            remaining = balance
+            mass = sum(pdf[k] for k in nodes[:num_nodes])
+            capped = {}
+            for i in by_ratio:
+                if i >= num_nodes:
+                    continue
+                k = nodes[i]
+                cap = limits.get(k, math.inf)
+                if remaining < cap / pdf[k] * mass:
+                    break
+                capped[k] = math.floor(cap)
+                remaining -= cap
+                mass -= pdf[k]
+            return {k: capped[k] if k in capped
+                    else math.floor(remaining * pdf[k] / mass)
+                    for k in nodes[:num_nodes]}
 
-            s = sum(pdf.values())
-            pdf = {k: v / s for k, v in pdf.items()}
+        def feasible(num_nodes):
+            return min(allocate(num_nodes).values()) >= minimal_channel_balance
 
-            min_probability = min(pdf.values())
-            needed_total_balance = math.ceil(
-                minimal_channel_balance / min_probability)
+        low, high = 0, len(nodes)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if feasible(mid):
+                low = mid
+            else:
+                high = mid - 1
+        if low == 0:
             self.__logger.info(
-                "Need at least a balance of {} satoshi to open {} channels".format(
-                    needed_total_balance, len(pdf)))
+                "Balance of {} satoshi is not enough to open a channel".format(
+                    balance))
+            return {}
 
-        return pdf
+        channels = allocate(low)
+        self.__logger.info(
+            "Use {} of {} satoshi to open {} of {} proposed channels".format(
+                sum(channels.values()), balance, low, len(pdf)))
+        return channels
 
+    def exclusion_index(self, node_ids):
+        """
+        sorted indices of the given nodes to exclude them from find_candidates
 
+        ids which are not part of the network are ignored. The index stays
+        valid until the snapshot is changed by update_channels
+        """
+        index = self.snapshot.index
+        return np.unique(np.array([index[n] for n in node_ids if n in index],
+                                  dtype=np.int64))
 
     def find_candidates(self, num_items=21,strategy = Strategy.DIVERSE, 
-                        percentile = None):
+                        percentile = None, exclude = None):
         self.__logger.info("running the autopilot on a graph with {} nodes and {} edges.".format(
-            len(self.G.nodes()), len(self.G.edges())))
+            self.snapshot.num_nodes, self.snapshot.num_edges))
         """
         Generates candidates with several strategies
+
+        exclude is an exclusion index (see exclusion_index) of nodes which
+        must not be proposed, e.g. current peers or banned nodes. They are
+        masked in the distributions before sampling.
         """
-        sub_k = math.ceil(num_items / 4)
         self.__logger.info(
             "GENERATE CANDIDATES: Try to generate up to {} nodes with 4 strategies: (random, central, network Improvement, liquidity)".format(num_items))
         # FIXME: should remember from where nodes are known
         
         res = self.__create_pdfs()
         
-        candidats = set()
+        candidats = []
         # FIXME: Run simulations to decide the following problem:
         """
         we can either do a global sampling by merging all probability 
@@ -395,36 +951,74 @@ class Autopilot():
         dominated by one very skew distribution. as mentioned this needs
         to be tested
         """
+        if exclude is not None and len(exclude):
+            self.__logger.info(
+                "GENERATE CANDIDATES: Exclude {} nodes".format(len(exclude)))
+
         if strategy == Strategy.DIVERSE:
-            for strategy, pdf in res.items():
-                tmp = self.__sample_from_percentile(pdf, percentile, sub_k)
-                candidats = candidats.union(set(tmp))
+            # every heuristic draws an equal share of the candidates, the
+            # remainder goes to randomly chosen heuristics. Nodes drawn from
+            # one heuristic are excluded from the next ones and a heuristic
+            # which runs out of nodes passes its share on
+            sub_ks = np.full(len(res), num_items // len(res))
+            sub_ks[self.rng.choice(len(res), num_items % len(res),
+                                   replace=False)] += 1
+            missing = 0
+            for (name, pdf), sub_k in zip(res.items(), sub_ks):
+                tmp = self.__sample_from_percentile(name, pdf, percentile,
+                                                    int(sub_k) + missing,
+                                                    candidats, exclude)
+                missing += int(sub_k) - len(tmp)
+                candidats.extend(tmp.tolist())
                 
         elif strategy == Strategy.MERGE:
-            merged = {}
-            denominator = len(res)
-            for pdf in res.values():
-                for k, v in pdf.items():
-                    if k not in merged:
-                        merged[k] = v/denominator
-                    else:
-                        merged[k] += v/denominator
-            candidats = self.__sample_from_percentile(merged, percentile, 
-                                                      num_items)
+            weights = np.full(len(res), 1 / len(res))
+            merged = weights @ np.vstack(list(res.values()))
+            candidats = self.__sample_from_percentile(
+                "merge", merged, percentile, num_items, (), exclude).tolist()
         """
         following code prints a list of candidates for debugging
         for k in res:
-            if "alias" in self.G.node[key[k]]:
-                print(pdf[key[k]], self.G.node[key[k]]["alias"])
+            print(pdf[k], self.snapshot.aliases[k])
         """
 
-        if len(candidats) > num_items:
-            candidats = np.random.choice(list(candidats), num_items, replace=False)
+        candidats = [self.__nodes[i] for i in candidats]
 
         self.__logger.info(
             "GENERATE CANDIDATES: Found {} nodes with which channel creation is suggested".format(
                 len(candidats)))
         return candidats
 
+    def plan(self, balances, channel_counts, strategies=(Strategy.DIVERSE,),
+             percentiles=(None,), max_share=None, exclude=None):
+        """
+        proposes channels for every combination of the given settings
+
+        the heuristics are computed once for all combinations. Candidates
+        are drawn once per strategy, percentile and channel count and then
+        the balance is split among them for every balance, so proposals for
+        different balances only differ in the amounts (and dropped nodes).
+
+        returns a list of dictionaries with the settings and the proposed
+        channels (node -> satoshi) of every combination
+        """
+        rows = []
+        for strategy in strategies:
+            for percentile in percentiles:
+                for num_channels in channel_counts:
+                    candidates = self.find_candidates(num_channels, strategy,
+                                                      percentile, exclude)
+                    pdf = self.calculate_statistics(candidates, verbose=False)
+                    for balance in balances:
+                        rows.append({
+                            "strategy": strategy,
+                            "percentile": percentile,
+                            "channels": num_channels,
+                            "balance": balance,
+                            "proposal": self.calculate_proposed_channel_capacities(
+                                pdf, balance, max_share),
+                        })
+        return rows
+
 if __name__ == '__main__':
     print("This lib needs to be given a network graph so you need to create a wrapper")
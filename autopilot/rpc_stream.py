@@ -0,0 +1,88 @@
+'''
+Incremental reader for large JSON-RPC responses of lightningd
+
+listchannels and listnodes return one JSON object holding an array with an
+entry for every channel or node of the network. LightningRpc reads and
+decodes the whole response before returning it, so the complete response
+string and the complete decoded list are held in memory at the same time.
+
+stream_rpc_array sends the request on its own unix socket and yields the
+entries of the array one by one while the response is still being read.
+Only the undecoded tail of the response is kept in a buffer.
+'''
+
+import codecs
+import json
+import re
+import socket
+
+
+class StreamError(ValueError):
+    pass
+
+
+_WHITESPACE = " \t\n\r,"
+
+
+def stream_rpc_array(socket_path, method, key, params=None,
+                     chunk_size=65536):
+    """
+    yields the entries of result[key] of the RPC call method(params)
+
+    raises StreamError if lightningd answers with an error or the response
+    ends before the array is complete
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        request = {"method": method, "params": params or {}, "id": 0}
+        sock.sendall(json.dumps(request).encode("UTF-8"))
+
+        decoder = codecs.getincrementaldecoder("UTF-8")()
+        json_decoder = json.JSONDecoder()
+        start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+        buf = ""
+        eof = False
+
+        def read():
+            nonlocal eof
+            data = sock.recv(chunk_size)
+            if not data:
+                eof = True
+            return decoder.decode(data, final=eof)
+
+        # search the beginning of the array
+        while True:
+            match = start.search(buf)
+            if match:
+                break
+            if '"error"' in buf or eof:
+                raise StreamError(
+                    "{} did not return {}: {}".format(method, key, buf[:1000]))
+            buf += read()
+        pos = match.end()
+
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    raise StreamError("{} response ended early".format(method))
+                buf = read()
+                pos = 0
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                entry, end = json_decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # the entry is not complete yet
+                if eof:
+                    raise StreamError("{} response ended early".format(method))
+                buf = buf[pos:] + read()
+                pos = 0
+                continue
+            pos = end
+            yield entry
+    finally:
+        sock.close()
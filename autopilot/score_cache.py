@@ -0,0 +1,57 @@
+'''
+Persistent on-disk cache for the heuristic scores of lib_autopilot
+
+Computing centrality and path length sums of the lightning network takes
+minutes while the graph often did not change between two runs of the
+autopilot. The cache stores the raw scores of every heuristic in one numpy
+file per key. Keys are built from the fingerprint of the GraphSnapshot and
+the sampling settings, so a changed network never hits a stale entry.
+
+The cache holds at most max_entries files. Loading an entry marks it as
+recently used and storing a new entry evicts the least recently used ones.
+'''
+
+import logging
+import os
+
+import numpy as np
+
+
+class ScoreCache():
+
+    def __init__(self, directory, max_entries=8):
+        self.__logger = logging.getLogger('lib-autopilot')
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        """ returns the dictionary of score vectors or None on a miss """
+        path = self.__path(key)
+        try:
+            with np.load(path) as data:
+                scores = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return scores
+
+    def store(self, key, scores):
+        """ atomically writes the score vectors and evicts old entries """
+        path = self.__path(key)
+        tmppath = path + ".tmp"
+        with open(tmppath, "wb") as f:
+            np.savez(f, **scores)
+        os.rename(tmppath, path)
+        self.__evict()
+
+    def __evict(self):
+        entries = [os.path.join(self.directory, f)
+                   for f in os.listdir(self.directory) if f.endswith(".npz")]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[self.max_entries:]:
+            self.__logger.info("Evict cached heuristic scores: {}".format(path))
+            os.remove(path)
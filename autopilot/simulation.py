@@ -0,0 +1,214 @@
+'''
+Simulation framework to evaluate the strategies of lib_autopilot
+
+Starting from a network graph (a recorded snapshot or legacy pickle file as
+written by c-lightning-autopilot.py or a generated scale-free graph) new nodes join
+the network one after another. Every new node uses the autopilot with the
+chosen strategy to find its channel partners and to split its balance among
+them. The channels are added to the graph with Autopilot.update_channels so
+the heuristics are updated incrementally between two steps.
+
+After every step the run time of the autopilot is recorded. Every
+metrics_interval steps the topology of the network is measured:
+
+* diameter: largest eccentricity of the sampled source nodes (a lower bound
+  of the diameter if sources are sampled)
+* average_path_length: mean hop distance between connected pairs of nodes
+* degree_centralization: Freeman centralization of the degree distribution
+
+usage: simulation.py [-h] [-i INPUT] [-n NODES] [-m EDGES]
+                     [-s {diverse,merge} [{diverse,merge} ...]] [-j JOINS]
+                     [-c CHANNELS] [-b BALANCE] [-p PERCENTILE_CUTOFF]
+                     [--metrics_interval METRICS_INTERVAL]
+                     [--metrics_samples METRICS_SAMPLES]
+                     [--centrality_samples CENTRALITY_SAMPLES]
+                     [--path_samples PATH_SAMPLES] [--seed SEED] [-o OUTPUT]
+
+a good example call of the program could look like that:
+
+python3 simulation.py -n 2000 -j 50 -c 10 -s diverse merge -o report.csv
+
+This call lets 50 nodes with 10 channels each join a generated network of
+2000 nodes, once with the diverse and once with the merge strategy, and
+writes the metrics of both runs to report.csv (use a .json file name for a
+json report).
+'''
+
+import argparse
+import csv
+import json
+import logging
+import time
+
+import numpy as np
+
+from benchmark import generate_graph
+from graph_snapshot import GraphSnapshot, load_graph_file
+from lib_autopilot import Autopilot, Strategy
+
+
+def distance_statistics(snapshot, samples=None, rng=None):
+    """
+    diameter and average path length from breadth first searches
+
+    if samples is set only this number of random sources is drawn with rng
+    """
+    offsets, targets = snapshot.adjacency()
+    num_nodes = snapshot.num_nodes
+    if samples is None or samples >= num_nodes:
+        sources = range(num_nodes)
+    else:
+        if rng is None:
+            rng = np.random.default_rng()
+        sources = rng.choice(num_nodes, samples, replace=False)
+
+    diameter = 0
+    total = 0
+    pairs = 0
+    for source in sources:
+        distances = [-1] * num_nodes
+        distances[source] = 0
+        frontier = [source]
+        depth = 0
+        while frontier:
+            next_frontier = []
+            for n in frontier:
+                for j in range(offsets[n], offsets[n + 1]):
+                    m = targets[j]
+                    if distances[m] < 0:
+                        distances[m] = depth + 1
+                        next_frontier.append(m)
+            if next_frontier:
+                depth += 1
+                total += depth * len(next_frontier)
+                pairs += len(next_frontier)
+            frontier = next_frontier
+        diameter = max(diameter, depth)
+    return diameter, total / max(pairs, 1)
+
+
+def degree_centralization(snapshot):
+    """ Freeman centralization of the node degrees (1 for a star) """
+    n = snapshot.num_nodes
+    if n < 3:
+        return 0.0
+    degrees = snapshot.degrees()
+    return float((degrees.max() - degrees).sum()) / ((n - 1) * (n - 2))
+
+
+def new_node_ids(snapshot, count):
+    """ ids for the joining nodes which sort like the existing ones """
+    if snapshot.nodes and isinstance(snapshot.nodes[0], (int, np.integer)):
+        start = max(snapshot.nodes) + 1
+        return list(range(start, start + count))
+    return ["simulated-{:06}".format(i) for i in range(count)]
+
+
+def simulate(snapshot, strategy=Strategy.DIVERSE, joins=20, channels=10,
+             balance=10000000, percentile=None, metrics_interval=1,
+             metrics_samples=100, **autopilot_args):
+    """
+    lets joins nodes join the network using the autopilot
+
+    returns one row per step with the run time of the autopilot and, every
+    metrics_interval steps, the topology metrics of the network
+    """
+    autopilot = Autopilot(snapshot, **autopilot_args)
+    rows = []
+    for step, node in enumerate(new_node_ids(snapshot, joins), 1):
+        start = time.time()
+        candidates = autopilot.find_candidates(channels, strategy, percentile)
+        pdf = autopilot.calculate_statistics(candidates, verbose=False)
+        capacities = autopilot.calculate_proposed_channel_capacities(
+            pdf, balance)
+        added = [(node, candidate, satoshis)
+                 for candidate, satoshis in capacities.items()]
+        autopilot.update_channels(added)
+        step_time = time.time() - start
+
+        row = {
+            "strategy": strategy,
+            "step": step,
+            "nodes": autopilot.snapshot.num_nodes,
+            "edges": autopilot.snapshot.num_edges,
+            "channels_opened": len(added),
+            "step_seconds": step_time,
+        }
+        if step % metrics_interval == 0 or step == joins:
+            diameter, average = distance_statistics(autopilot.snapshot,
+                                                    metrics_samples,
+                                                    autopilot.rng)
+            row["diameter"] = diameter
+            row["average_path_length"] = average
+            row["degree_centralization"] = degree_centralization(
+                autopilot.snapshot)
+        rows.append(row)
+        print("{} step {}/{}: {:.2f}s".format(strategy, step, joins,
+                                              step_time))
+    return rows
+
+
+def write_report(rows, output):
+    if output.endswith(".json"):
+        with open(output, "w") as f:
+            json.dump(rows, f, indent=2)
+        return
+    fields = []
+    for row in rows:
+        fields += [k for k in row if k not in fields]
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input",
+                        help="points to a graph snapshot or pickle file")
+    parser.add_argument("-n", "--nodes", type=int, default=2000,
+                        help="number of nodes of the generated graph")
+    parser.add_argument("-m", "--edges", type=int, default=2,
+                        help="edges per new node of the generated graph")
+    parser.add_argument("-s", "--strategy", nargs="+",
+                        choices=[Strategy.DIVERSE, Strategy.MERGE],
+                        default=[Strategy.DIVERSE],
+                        help="strategies to simulate, one run each")
+    parser.add_argument("-j", "--joins", type=int, default=20,
+                        help="number of nodes joining the network")
+    parser.add_argument("-c", "--channels", type=int, default=10,
+                        help="channels opened by every joining node")
+    parser.add_argument("-b", "--balance", type=int, default=10000000,
+                        help="satoshis of every joining node")
+    parser.add_argument("-p", "--percentile_cutoff", type=float,
+                        help="only uses the top percentile of each probability distribution")
+    parser.add_argument("--metrics_interval", type=int, default=1,
+                        help="measure the topology every this many steps")
+    parser.add_argument("--metrics_samples", type=int, default=100,
+                        help="number of sources for diameter and path lengths")
+    parser.add_argument("--centrality_samples", type=int,
+                        help="approximate the betweenness centrality by sampling this number of source nodes")
+    parser.add_argument("--path_samples", type=int,
+                        help="estimate the path length sums from this number of sampled source nodes")
+    parser.add_argument("--seed", type=int,
+                        help="seed of the random number generator")
+    parser.add_argument("-o", "--output", default="simulation.csv",
+                        help="csv or json file for the report")
+
+    args = parser.parse_args()
+    logging.getLogger('lib-autopilot').disabled = True
+
+    if args.input:
+        snapshot = load_graph_file(args.input)
+    else:
+        snapshot = GraphSnapshot.from_networkx(
+            generate_graph(args.nodes, args.edges, seed=1))
+    rows = []
+    for strategy in args.strategy:
+        rows += simulate(snapshot, strategy, args.joins, args.channels,
+                         args.balance, args.percentile_cutoff,
+                         args.metrics_interval, args.metrics_samples,
+                         centrality_samples=args.centrality_samples,
+                         path_samples=args.path_samples, seed=args.seed)
+    write_report(rows, args.output)
+    print("Report written to {}".format(args.output))
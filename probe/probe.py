@@ -8,42 +8,75 @@ payments being rejected at the destination, so no funds are actually
 transferred. The error messages however allow us to gather some information
 about the success probability of a payment, and the stability of the channels.
 
+Probes are launched at a target rate (`probe-rate` probes per hour, by default
+one every `probe-interval` seconds) by a pool of up to `probe-concurrency`
+concurrent probes. The total amount of all probes in flight is capped by
+`probe-max-inflight-msat` and every probe is given up after `probe-timeout`
+seconds.
+
 The random selection of destination nodes is a worst case scenario, since it's
 likely that most of the nodes in the network are leaf nodes that are not
 well-connected and often offline at any point in time. Expect to see a lot of
 errors about being unable to route these payments as a result of this.
 
+Destinations are drawn from an in-memory node index that is refreshed every
+`probe-node-refresh` seconds. `probe-destination-weight` selects how they are
+weighted:
+
+ - `uniform` draws every known node with the same probability.
+ - `address` only draws nodes that announce an address.
+ - `capacity` draws nodes proportional to the capacity of their channels.
+ - `success` draws nodes proportional to their past probe success rate, so
+   nodes that were unreachable before are rarely probed again.
+
 The probe data is stored in a sqlite3 database for later inspection and to be
 able to eventually draw pretty plots about how the network stability changes
-over time. For now you can inspect the results using the `sqlite3` command
-line utility:
+over time. Finished probes are written by a background thread in batches,
+once every `probe-flush-interval` seconds, and the database uses write-ahead
+logging so that reading it doesn't block the plugin. You can inspect the
+results using the `sqlite3` command line utility:
 
 ```bash
 sqlite3  ~/.lightning/probes.db "select destination, erring_channel, failcode from probes"
 ```
 
-Failcode -1 and 16399 are special:
+While writing the probes the plugin also keeps hourly aggregates per channel
+and per destination (attempts, successes, failures, a histogram of the
+failcodes and when they were last seen) for the last `probe-stats-retention`
+days. The `probestats` method queries them, e.g. the channels that failed most
+in the last 24 hours:
+
+```bash
+lightning-cli probestats channel 24 failures 10
+```
+
+Failcode -1, -2 and 16399 are special:
 
  - -1 indicates that we were unable to find a route to the destination. This
     usually indicates that this is a leaf node that is currently offline.
 
+ - -2 indicates that the probe did not return before its deadline.
+
  - 16399 is the code for unknown payment details and indicates a successful
    probe. The destination received the incoming payment but could not find a
    matching `payment_key`, which is expected since we generated the
    `payment_hash` at random :-)
 
 """
-from datetime import datetime
+from datetime import datetime, timedelta
 from lightning import Plugin, RpcError
+from itertools import accumulate
 from random import choice
 from sqlalchemy import Column, Integer, String, DateTime
-from sqlalchemy import create_engine
+from sqlalchemy import cast, create_engine, event, func, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from time import sleep, time
+import bisect
 import heapq
 import json
 import os
+import queue
 import random
 import string
 import threading
@@ -54,65 +87,327 @@ plugin = Plugin()
 
 exclusions = []
 temporary_exclusions = {}
+# probes run concurrently with clear_temporary_exclusion
+exclusions_lock = threading.Lock()
 
 
 class Probe(Base):
     __tablename__ = "probes"
     id = Column(Integer, primary_key=True)
-    destination = Column(String)
+    destination = Column(String, index=True)
     route = Column(String)
     error = Column(String)
-    erring_channel = Column(String)
-    failcode = Column(Integer)
+    erring_channel = Column(String, index=True)
+    failcode = Column(Integer, index=True)
     payment_hash = Column(String)
-    started_at = Column(DateTime)
+    started_at = Column(DateTime, index=True)
     finished_at = Column(DateTime)
 
 
-def start_probe(plugin):
-    t = threading.Thread(target=probe, args=[plugin])
-    t.daemon = True
-    t.start()
+class Stats(object):
+    """Columns of the hourly aggregates of probes.
+
+    For channels `failures` counts the probes the channel was the erring
+    channel of, for destinations it counts all unsuccessful probes.
+    `failcodes` is a JSON object mapping failcodes to their number.
+    """
+    bucket = Column(DateTime, primary_key=True, index=True)
+    attempts = Column(Integer, default=0)
+    successes = Column(Integer, default=0)
+    failures = Column(Integer, default=0)
+    failcodes = Column(String, default='{}')
+    last_seen = Column(DateTime)
+
+
+class ChannelStats(Stats, Base):
+    __tablename__ = "channel_stats"
+    key_name = 'channel'
+    channel = Column(String, primary_key=True)
+
+
+class DestinationStats(Stats, Base):
+    __tablename__ = "destination_stats"
+    key_name = 'destination'
+    destination = Column(String, primary_key=True)
+
+
+def update_stats(session, probes):
+    """Adds the finished probes to the hourly aggregates."""
+    updates = {}
+    for p in probes:
+        bucket = p.started_at.replace(minute=0, second=0, microsecond=0)
+        success = p.failcode == 16399
+        keys = [(DestinationStats, p.destination, not success)]
+        if p.route:
+            keys += [(ChannelStats, c, not success and c == p.erring_channel)
+                     for c in p.route.split(',')]
+        # probes of earlier versions were not finished when no route was found
+        last_seen = p.finished_at or p.started_at
+        for model, key, failed in keys:
+            u = updates.setdefault((model, key, bucket), {
+                'attempts': 0, 'successes': 0, 'failures': 0,
+                'failcodes': {}, 'last_seen': last_seen
+            })
+            u['attempts'] += 1
+            u['successes'] += int(success)
+            if failed:
+                u['failures'] += 1
+                failcode = str(p.failcode)
+                u['failcodes'][failcode] = u['failcodes'].get(failcode, 0) + 1
+            u['last_seen'] = max(u['last_seen'], last_seen)
+
+    for (model, key, bucket), u in updates.items():
+        row = session.query(model).filter_by(
+            bucket=bucket, **{model.key_name: key}
+        ).first()
+        if row is None:
+            row = model(bucket=bucket, attempts=0, successes=0, failures=0,
+                        failcodes='{}', **{model.key_name: key})
+            session.add(row)
+        row.attempts += u['attempts']
+        row.successes += u['successes']
+        row.failures += u['failures']
+        failcodes = json.loads(row.failcodes)
+        for failcode, count in u['failcodes'].items():
+            failcodes[failcode] = failcodes.get(failcode, 0) + count
+        row.failcodes = json.dumps(failcodes)
+        row.last_seen = max(row.last_seen or u['last_seen'], u['last_seen'])
+
+
+class ProbeWriter(object):
+    """Writes finished probes to the database from a single thread.
+
+    Probes are queued by `put` and committed in one transaction every
+    `flush_interval` seconds, or as soon as `batch_size` probes are waiting,
+    together with the updated aggregates. `backfill` is called by the thread
+    before the first flush, so it is the only writer of the aggregates.
+    """
+    def __init__(self, Session, flush_interval, batch_size=500, backfill=None):
+        self.Session = Session
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.backfill = backfill
+        self.queue = queue.Queue()
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def put(self, probe):
+        self.queue.put(probe)
+
+    def run(self):
+        if self.backfill is not None:
+            try:
+                self.backfill()
+            except Exception as e:
+                print("Could not aggregate earlier probes: {}".format(e))
+        while True:
+            batch = [self.queue.get()]
+            deadline = time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time(), 0)))
+                except queue.Empty:
+                    break
+            self.flush(batch)
+
+    def flush(self, batch):
+        s = self.Session()
+        try:
+            s.add_all(batch)
+            update_stats(s, batch)
+            s.commit()
+        except Exception as e:
+            s.rollback()
+            print("Could not write {} probes: {}".format(len(batch), e))
+        finally:
+            s.close()
+
+
+class NodeIndex(object):
+    """In-memory index of the network's nodes to draw probe destinations from.
+
+    The index is rebuilt by `refresh` in the background, so drawing a
+    destination doesn't need any RPC call.
+    """
+    def __init__(self, weighting):
+        self.weighting = weighting
+        self.lock = threading.Lock()
+        self.nodes = []
+        self.cumulative = []
+        self.attempts = {}
+        self.successes = {}
+
+    def refresh(self, plugin):
+        nodes = plugin.rpc.listnodes()['nodes']
+        if self.weighting == 'address':
+            nodes = [n for n in nodes if n.get('addresses')]
+        node_ids = [n['nodeid'] for n in nodes]
+
+        if self.weighting == 'capacity':
+            capacities = {}
+            for c in plugin.rpc.listchannels()['channels']:
+                capacities[c['source']] = capacities.get(c['source'], 0) + c['satoshis']
+            weights = [capacities.get(n, 0) for n in node_ids]
+        elif self.weighting == 'success':
+            with self.lock:
+                weights = [
+                    (self.successes.get(n, 0) + 1) / (self.attempts.get(n, 0) + 2)
+                    for n in node_ids
+                ]
+        else:
+            weights = [1] * len(node_ids)
+
+        cumulative = list(accumulate(weights))
+        with self.lock:
+            self.nodes, self.cumulative = node_ids, cumulative
+        print("Indexed {} probe destinations".format(len(node_ids)))
+
+    def record(self, destination, success, attempts=1):
+        with self.lock:
+            self.attempts[destination] = self.attempts.get(destination, 0) + attempts
+            self.successes[destination] = self.successes.get(destination, 0) + int(success)
+
+    def choice(self):
+        with self.lock:
+            nodes, cumulative = self.nodes, self.cumulative
+        if not nodes or cumulative[-1] <= 0:
+            return None
+        i = bisect.bisect_right(cumulative, random.random() * cumulative[-1])
+        return nodes[min(i, len(nodes) - 1)]
+
+
+class Prober(object):
+    """Launches probes at a target rate with bounded concurrency.
+
+    At most `concurrency` probes run at the same time and the amounts of all
+    probes in flight never exceed `max_inflight_msat`. A probe whose payment
+    did not return before its deadline keeps its amount reserved until the
+    payment is resolved.
+    """
+    def __init__(self, plugin, concurrency, rate, max_inflight_msat, timeout):
+        self.plugin = plugin
+        self.interval = 3600 / rate
+        self.max_inflight_msat = max_inflight_msat
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.budget = threading.Condition()
+        self.inflight_msat = 0
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        next_run = time()
+        while True:
+            t = next_run - time()
+            if t > 0:
+                sleep(t)
+            self.slots.acquire()
+            # Don't catch up with probes which were delayed by a full pool
+            next_run = max(next_run + self.interval, time())
+            t = threading.Thread(target=self.run_probe)
+            t.daemon = True
+            t.start()
+
+    def run_probe(self):
+        try:
+            probe(self.plugin)
+        except Exception as e:
+            print("Probe failed: {}".format(e))
+        finally:
+            self.slots.release()
+
+    def reserve(self, msatoshi, deadline):
+        with self.budget:
+            while self.inflight_msat + msatoshi > self.max_inflight_msat:
+                if not self.budget.wait(deadline - time()):
+                    return False
+            self.inflight_msat += msatoshi
+            return True
+
+    def release(self, msatoshi):
+        with self.budget:
+            self.inflight_msat -= msatoshi
+            self.budget.notify_all()
+
+    def release_when_resolved(self, payment_hash, msatoshi):
+        def wait_and_release():
+            try:
+                self.plugin.rpc.waitsendpay(payment_hash)
+            except RpcError:
+                pass
+            finally:
+                self.release(msatoshi)
+
+        t = threading.Thread(target=wait_and_release)
+        t.daemon = True
+        t.start()
 
 
 @plugin.method('probe')
 def probe(plugin):
-    nodes = plugin.rpc.listnodes()['nodes']
-    dst = choice(nodes)
+    deadline = time() + plugin.prober.timeout
+    dst = plugin.nodes.choice()
+    if dst is None:
+        print("No probe destinations indexed yet")
+        return
 
-    s = plugin.Session()
-    p = Probe(destination=dst['nodeid'], started_at=datetime.now())
-    s.add(p)
+    p = Probe(destination=dst, started_at=datetime.now())
+    with exclusions_lock:
+        exclude = exclusions + list(temporary_exclusions.keys())
     try:
         route = plugin.rpc.getroute(
-            dst['nodeid'],
+            dst,
             msatoshi=10000,
             riskfactor=1,
-            exclude=exclusions + list(temporary_exclusions.keys())
+            exclude=exclude
         )['route']
         p.route = ','.join([r['channel'] for r in route])
         p.payment_hash = ''.join(choice(string.hexdigits) for _ in range(64))
     except RpcError:
         p.failcode = -1
-        s.commit()
+        plugin.nodes.record(dst, False)
+        p.finished_at = datetime.now()
+        plugin.writer.put(p)
+        return
+
+    amount = int(route[0]['msatoshi'])
+    if not plugin.prober.reserve(amount, deadline):
+        print("Skipping probe, too many probes in flight")
         return
-    s.commit()
 
+    release = True
     try:
         plugin.rpc.sendpay(route, p.payment_hash)
-        plugin.rpc.waitsendpay(p.payment_hash)
+        plugin.rpc.waitsendpay(p.payment_hash, max(int(deadline - time()), 1))
     except RpcError as e:
-        error = e.error['data']
-        p.erring_channel = e.error['data']['erring_channel']
-        p.failcode = e.error['data']['failcode']
-        p.error = json.dumps(error)
+        error = e.error.get('data')
+        if error is None or 'erring_channel' not in error:
+            # waitsendpay timed out, the payment is still in flight
+            p.failcode = -2
+            p.error = json.dumps(e.error)
+            plugin.prober.release_when_resolved(p.payment_hash, amount)
+            release = False
+        else:
+            p.erring_channel = error['erring_channel']
+            p.failcode = error['failcode']
+            p.error = json.dumps(error)
+    finally:
+        if release:
+            plugin.prober.release(amount)
 
     if p.failcode in [16392, 16394]:
         exclusion = "{erring_channel}/{erring_direction}".format(**error)
         print('Adding exclusion for channel {} ({} total))'.format(
             exclusion, len(exclusions))
         )
-        exclusions.append(exclusion)
+        with exclusions_lock:
+            exclusions.append(exclusion)
 
     if p.failcode == 4103:
         exclusion = "{erring_channel}/{erring_direction}".format(**error)
@@ -120,28 +415,147 @@ def probe(plugin):
             exclusion, len(temporary_exclusions))
         )
         expiry = time() + plugin.probe_exclusion_duration
-        temporary_exclusions[exclusion] = expiry
+        with exclusions_lock:
+            temporary_exclusions[exclusion] = expiry
 
+    plugin.nodes.record(dst, p.failcode == 16399)
     p.finished_at = datetime.now()
-    s.commit()
-    s.close()
+    plugin.writer.put(p)
+
+
+@plugin.method('probestats')
+def probestats(plugin, kind='channel', hours=24, sort='failures', limit=10):
+    """Aggregated probe results of the last hours.
+
+    Returns the channels or destinations (kind) with the most attempts,
+    successes or failures (sort).
+    """
+    models = {'channel': ChannelStats, 'destination': DestinationStats}
+    if kind not in models:
+        raise ValueError("kind must be one of {}".format(', '.join(models)))
+    if sort not in ['attempts', 'successes', 'failures']:
+        raise ValueError("sort must be one of attempts, successes or failures")
+    model = models[kind]
+    key = getattr(model, model.key_name)
+    since = datetime.now() - timedelta(hours=float(hours))
+    since = since.replace(minute=0, second=0, microsecond=0)
+
+    s = plugin.Session()
+    try:
+        rows = s.query(
+            key,
+            func.sum(model.attempts),
+            func.sum(model.successes),
+            func.sum(model.failures),
+            func.max(model.last_seen)
+        ).filter(model.bucket >= since).group_by(key).order_by(
+            func.sum(getattr(model, sort)).desc()
+        ).limit(int(limit)).all()
+
+        failcodes = {r[0]: {} for r in rows}
+        histograms = s.query(key, model.failcodes).filter(
+            model.bucket >= since, key.in_(list(failcodes))
+        )
+        for k, histogram in histograms:
+            for failcode, count in json.loads(histogram).items():
+                failcodes[k][failcode] = failcodes[k].get(failcode, 0) + count
+    finally:
+        s.close()
+
+    return {
+        'since': since.isoformat(),
+        kind + 's': [{
+            kind: k,
+            'attempts': attempts,
+            'successes': successes,
+            'failures': failures,
+            'failcodes': failcodes[k],
+            'last_seen': last_seen.isoformat() if last_seen else None,
+        } for k, attempts, successes, failures, last_seen in rows]
+    }
+
+
+def prune_stats(plugin):
+    since = datetime.now() - timedelta(days=plugin.stats_retention)
+    s = plugin.Session()
+    try:
+        for model in [ChannelStats, DestinationStats]:
+            s.query(model).filter(model.bucket < since).delete()
+        s.commit()
+    finally:
+        s.close()
 
 
 def clear_temporary_exclusion(plugin):
-    timed_out = [k for k, v in temporary_exclusions.items() if v < time()]
-    for k in timed_out:
-        del temporary_exclusions[k]
+    with exclusions_lock:
+        timed_out = [k for k, v in temporary_exclusions.items() if v < time()]
+        for k in timed_out:
+            del temporary_exclusions[k]
+        remaining = len(temporary_exclusions)
 
     print("Removed {}/{} temporary exclusions.".format(
-        len(timed_out), len(temporary_exclusions))
+        len(timed_out), remaining)
     )
 
 
+def refresh_nodes(plugin):
+    try:
+        plugin.nodes.refresh(plugin)
+    except RpcError as e:
+        print("Could not refresh the node index: {}".format(e))
+
+
+def backfill_stats(plugin, batch_size=1000):
+    """Builds the aggregates from the probes of the last retention days.
+
+    Only runs if the aggregates are empty, i.e. once after upgrading from a
+    version without them. Called from the writer thread, so it doesn't delay
+    the start of the plugin.
+    """
+    s = plugin.Session()
+    try:
+        if s.query(DestinationStats).first() is not None:
+            return
+        since = datetime.now() - timedelta(days=plugin.stats_retention)
+        last_id = 0
+        total = 0
+        while True:
+            probes = s.query(Probe).filter(
+                Probe.id > last_id,
+                Probe.started_at >= since,
+                Probe.failcode.isnot(None)
+            ).order_by(Probe.id).limit(batch_size).all()
+            if not probes:
+                break
+            update_stats(s, probes)
+            s.commit()
+            last_id = probes[-1].id
+            total += len(probes)
+        if total:
+            print("Aggregated {} earlier probes".format(total))
+    finally:
+        s.close()
+
+
+def load_node_stats(plugin):
+    # the aggregates only cover the retention period, seed from all probes
+    s = plugin.Session()
+    rows = s.query(
+        Probe.destination,
+        func.count(Probe.id),
+        func.sum(cast(Probe.failcode == 16399, Integer))
+    ).filter(Probe.failcode.isnot(None)).group_by(Probe.destination)
+    for destination, attempts, successes in rows:
+        plugin.nodes.record(destination, successes or 0, attempts)
+    s.close()
+
+
 def schedule(plugin):
     # List of scheduled calls with next runtime, function and interval
     next_runs = [
+        (time(), refresh_nodes, plugin.node_refresh),
         (time() + 300, clear_temporary_exclusion, 300),
-        (time() + plugin.probe_interval, start_probe, plugin.probe_interval)
+        (time() + 3600, prune_stats, 3600),
     ]
     heapq.heapify(next_runs)
 
@@ -150,8 +564,11 @@ def schedule(plugin):
         t = n[0] - time()
         if t > 0:
             sleep(t)
-        # Call the function
-        n[1](plugin)
+        # Call the function, a failure must not stop the other scheduled calls
+        try:
+            n[1](plugin)
+        except Exception as e:
+            print("Scheduled call {} failed: {}".format(n[1].__name__, e))
 
         # Schedule the next run
         heapq.heappush(next_runs, (time() + n[2], n[1], n[2]))
@@ -161,19 +578,56 @@ def schedule(plugin):
 def init(configuration, options, plugin):
     plugin.probe_interval = int(options['probe-interval'])
     plugin.probe_exclusion_duration = int(options['probe-exclusion-duration'])
+    plugin.node_refresh = int(options['probe-node-refresh'])
+    plugin.stats_retention = int(options['probe-stats-retention'])
+    weighting = options['probe-destination-weight']
+    if weighting not in ['uniform', 'address', 'capacity', 'success']:
+        raise ValueError("Unknown probe-destination-weight {}".format(weighting))
+    plugin.nodes = NodeIndex(weighting)
+    rate = float(options['probe-rate']) or 3600 / plugin.probe_interval
+    plugin.prober = Prober(
+        plugin,
+        concurrency=int(options['probe-concurrency']),
+        rate=rate,
+        max_inflight_msat=int(options['probe-max-inflight-msat']),
+        timeout=int(options['probe-timeout'])
+    )
 
     db_filename = 'sqlite:///' + os.path.join(
         configuration['lightning-dir'],
         'probes.db'
     )
 
-    engine = create_engine(db_filename, echo=True)
+    engine = create_engine(db_filename, echo=False)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(connection, record):
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
     Base.metadata.create_all(engine)
+    # create_all doesn't add indexes to tables created by earlier versions
+    with engine.begin() as connection:
+        for column in ['destination', 'erring_channel', 'failcode', 'started_at']:
+            connection.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_probes_{0} ON probes ({0})".format(column)
+            ))
     plugin.Session = sessionmaker()
     plugin.Session.configure(bind=engine)
+    plugin.writer = ProbeWriter(
+        plugin.Session,
+        flush_interval=int(options['probe-flush-interval']),
+        backfill=lambda: backfill_stats(plugin)
+    )
+    plugin.writer.start()
+    if weighting == 'success':
+        load_node_stats(plugin)
     t = threading.Thread(target=schedule, args=[plugin])
     t.daemon = True
     t.start()
+    plugin.prober.start()
 
 
 plugin.add_option(
@@ -181,6 +635,46 @@ plugin.add_option(
     '3600',
     'How many seconds should we wait between probes?'
 )
+plugin.add_option(
+    'probe-rate',
+    '0',
+    'How many probes should we start per hour? (0 to use probe-interval)'
+)
+plugin.add_option(
+    'probe-concurrency',
+    '4',
+    'How many probes may be in flight at the same time?'
+)
+plugin.add_option(
+    'probe-max-inflight-msat',
+    '1000000',
+    'How many millisatoshi may all probes in flight add up to?'
+)
+plugin.add_option(
+    'probe-timeout',
+    '60',
+    'How many seconds should we wait for the result of a probe?'
+)
+plugin.add_option(
+    'probe-node-refresh',
+    '1800',
+    'How many seconds should we wait between refreshes of the node index?'
+)
+plugin.add_option(
+    'probe-destination-weight',
+    'uniform',
+    'How to weight probe destinations: uniform, address, capacity or success'
+)
+plugin.add_option(
+    'probe-flush-interval',
+    '10',
+    'How many seconds may finished probes wait before they are written?'
+)
+plugin.add_option(
+    'probe-stats-retention',
+    '30',
+    'How many days should the aggregated probe statistics be kept?'
+)
 plugin.add_option(
     'probe-exclusion-duration',
     '1800',
@@ -1,23 +1,381 @@
 #!/usr/bin/env python3
 from lightning import Plugin, Millisatoshi, RpcError
+from collections import namedtuple, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import heapq
+import json
+import os
+import threading
 import time
 import uuid
 
 plugin = Plugin()
 
+# failcode flag of onion errors which carry a channel_update
+UPDATE = 0x1000
+# rebalanceall reserves this multiple of the estimated fee of every rebalance
+FEE_HEADROOM = 1.5
+MPP_TIMEOUT = 23
+
+Policy = namedtuple('Policy', ['base_fee', 'fee_per_millionth', 'delay'])
+Edge = namedtuple('Edge', ['source', 'destination', 'channel', 'direction', 'base_fee',
+                           'fee_per_millionth', 'delay', 'htlc_minimum', 'htlc_maximum'])
+
+
+class ChannelGraph(object):
+    """Local snapshot of the channel graph with the fee and delay policies.
+
+    Routes are computed locally instead of asking `getroute` on every attempt.
+    """
+    def __init__(self, channels):
+        self.timestamp = time.time()
+        self.incoming = {}
+        self.edges = {}
+        for ch in channels:
+            if not ch['active']:
+                continue
+            htlc_maximum = int(ch.get('htlc_maximum_msat', ch['satoshis'] * 1000))
+            edge = Edge(ch['source'], ch['destination'], ch['short_channel_id'],
+                        ch['channel_flags'] & 1, ch['base_fee_millisatoshi'],
+                        ch['fee_per_millionth'], ch['delay'],
+                        int(ch.get('htlc_minimum_msat', 0)),
+                        min(htlc_maximum, ch['satoshis'] * 1000))
+            self.edges[(edge.channel, edge.direction)] = edge
+            self.incoming.setdefault(edge.destination, []).append(edge)
+
+    @classmethod
+    def from_rpc(cls, rpc):
+        return cls(rpc.listchannels().get('channels'))
+
+    @staticmethod
+    def fee(edge, msatoshi):
+        return edge.base_fee + msatoshi * edge.fee_per_millionth // 1000000
+
+    def __search(self, toid, msatoshi, excludes, exclude_nodes, fromid=None):
+        # Dijkstra from the destination back to the source, as the fees of
+        # a hop depend on the amount which is forwarded by the next hops
+        best = {toid: (msatoshi, 0)}
+        nexthop = {}
+        heap = [(msatoshi, 0, toid)]
+        while heap:
+            amount, delay, node = heapq.heappop(heap)
+            if node == fromid:
+                break
+            if best[node] < (amount, delay):
+                continue
+            for edge in self.incoming.get(node, []):
+                if edge.source in exclude_nodes or edge in excludes:
+                    continue
+                if not edge.htlc_minimum <= amount <= edge.htlc_maximum:
+                    continue
+                label = (amount + self.fee(edge, amount), delay + edge.delay)
+                if edge.source not in best or label < best[edge.source]:
+                    best[edge.source] = label
+                    nexthop[edge.source] = edge
+                    heapq.heappush(heap, label + (edge.source,))
+        return best, nexthop
+
+    def __cheapest(self, fromid, toid, msatoshi, excludes, exclude_nodes):
+        _, nexthop = self.__search(toid, msatoshi, excludes, exclude_nodes, fromid)
+        if fromid not in nexthop:
+            return None
+        path = []
+        node = fromid
+        while node != toid:
+            path.append(nexthop[node])
+            node = nexthop[node].destination
+        return path
+
+    def amounts_to(self, toid, msatoshi, exclude_nodes=()):
+        """Amounts every node has to send on the cheapest route to deliver msatoshi to toid."""
+        best, _ = self.__search(toid, msatoshi, set(), set(exclude_nodes))
+        return {node: label[0] for node, label in best.items()}
+
+    def __cost(self, path, msatoshi):
+        amount, delay = msatoshi, 0
+        for edge in reversed(path):
+            amount += self.fee(edge, amount)
+            delay += edge.delay
+        return amount, delay
+
+    def routes(self, fromid, toid, msatoshi, k=5, excludes=(), exclude_nodes=()):
+        """Returns up to k cheapest routes from fromid to toid (Yen's algorithm).
+
+        msatoshi is the amount to be delivered to toid. excludes is a list of
+        'short_channel_id/direction' and exclude_nodes are never passed.
+        Routes are lists of hops in the format of `getroute`, without amounts.
+        """
+        excluded = set(edge for edge in self.edges.values()
+                       if "%s/%d" % (edge.channel, edge.direction) in excludes)
+        exclude_nodes = set(exclude_nodes)
+        path = self.__cheapest(fromid, toid, msatoshi, excluded, exclude_nodes)
+        if path is None:
+            return []
+        found = [path]
+        candidates = []
+        while len(found) < k:
+            last = found[-1]
+            for i in range(len(last)):
+                root = last[:i]
+                spur_node = last[i].source
+                spur_excludes = set(excluded)
+                for p in found:
+                    if p[:i] == root:
+                        spur_excludes.add(p[i])
+                spur_nodes = exclude_nodes | set(edge.source for edge in root)
+                spur = self.__cheapest(spur_node, toid, msatoshi, spur_excludes, spur_nodes)
+                if spur is None:
+                    continue
+                candidate = root + spur
+                if candidate in found or any(c[2] == candidate for c in candidates):
+                    continue
+                heapq.heappush(candidates, (self.__cost(candidate, msatoshi), len(candidates), candidate))
+            if not candidates:
+                break
+            found.append(heapq.heappop(candidates)[2])
+        return [[{'id': edge.destination, 'channel': edge.channel, 'direction': edge.direction}
+                 for edge in p] for p in found]
+
+
+class GraphThread(threading.Thread):
+    """Refreshes the local channel graph in the background."""
+    def __init__(self, plugin):
+        super().__init__()
+        self.plugin = plugin
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        while True:
+            time.sleep(int(self.plugin.get_option('rebalance-graph-refresh')))
+            try:
+                refresh_graph(self.plugin)
+            except Exception as e:
+                self.plugin.log("Could not refresh the channel graph: " + str(e))
+
+
+def refresh_graph(plugin):
+    graph = ChannelGraph.from_rpc(plugin.rpc)
+    with plugin.graph_lock:
+        plugin.graph = graph
+    plugin.log("Channel graph refreshed: %d channel directions" % len(graph.edges))
+    return graph
+
+
+def get_graph(plugin):
+    with plugin.graph_lock:
+        graph = plugin.graph
+    if graph is None:
+        graph = refresh_graph(plugin)
+    return graph
+
+
+class PolicyCache(object):
+    """LRU cache of (short_channel_id, direction) -> Policy with a time to live.
+
+    It is shared by all retries and concurrent rebalance calls. Misses are
+    answered by the local channel graph if it is younger than the time to
+    live, otherwise by `listchannels`.
+    """
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, plugin, channel, direction):
+        key = (channel, direction)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] + self.ttl > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        with plugin.graph_lock:
+            graph = plugin.graph
+        if graph is not None and graph.timestamp + self.ttl > time.time():
+            edge = graph.edges.get(key)
+            if edge is not None:
+                policy = Policy(edge.base_fee, edge.fee_per_millionth, edge.delay)
+                self.put(key, policy, graph.timestamp)
+                return policy
+
+        now = time.time()
+        policy = None
+        for ch in plugin.rpc.listchannels(channel).get('channels'):
+            p = Policy(ch['base_fee_millisatoshi'], ch['fee_per_millionth'], ch['delay'])
+            self.put((channel, ch['channel_flags'] & 1), p, now)
+            if ch['channel_flags'] & 1 == direction:
+                policy = p
+        return policy
+
+    def put(self, key, policy, timestamp):
+        with self.lock:
+            self.entries[key] = (policy, timestamp)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, channel):
+        with self.lock:
+            for direction in (0, 1):
+                self.entries.pop((channel, direction), None)
+
+    def stats(self):
+        with self.lock:
+            return "Policy cache: %d hits, %d misses, %d entries" % (self.hits, self.misses, len(self.entries))
+
+
+class SuccessModel(object):
+    """Decaying statistics of the payment attempts over every channel direction.
+
+    For 'short_channel_id/direction' it keeps the number of successful and
+    failed forwards, the failcodes, the largest amount that went through and
+    the smallest amount that failed. Counts lose half their weight every
+    halflife seconds. The statistics are shared by all rebalances and stored
+    in a json file by load and save, so they survive restarts of the plugin.
+    """
+    def __init__(self, path, halflife):
+        self.path = path
+        self.halflife = halflife
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.channels = {}
+
+    def load(self):
+        """Reads the statistics, raises ValueError if the file is corrupt."""
+        with open(self.path, 'r') as f:
+            channels = json.load(f)
+        if not isinstance(channels, dict):
+            raise ValueError("expected a json object")
+        with self.lock:
+            self.channels = channels
+
+    def save(self):
+        """Atomically writes the statistics, dropping the forgotten ones."""
+        now = time.time()
+        with self.lock:
+            for key in list(self.channels):
+                entry = self.__decayed(key, now)
+                if entry['successes'] + entry['failures'] < 0.01:
+                    del self.channels[key]
+            data = json.dumps(self.channels)
+        # concurrent rebalances save at the same time, each writes a whole file
+        with self.save_lock:
+            tmppath = self.path + '.tmp'
+            with open(tmppath, 'w') as f:
+                f.write(data)
+            os.rename(tmppath, self.path)
+
+    def __decayed(self, key, now):
+        entry = self.channels.setdefault(key, {'successes': 0.0, 'failures': 0.0, 'failcodes': {},
+                                               'max_success_msat': None, 'min_failure_msat': None,
+                                               'updated': now})
+        factor = 0.5 ** ((now - entry['updated']) / self.halflife)
+        entry['successes'] *= factor
+        entry['failures'] *= factor
+        for code in entry['failcodes']:
+            entry['failcodes'][code] *= factor
+        # forget amount limits which are not backed by recent attempts
+        if entry['successes'] < 0.1:
+            entry['max_success_msat'] = None
+        if entry['failures'] < 0.1:
+            entry['min_failure_msat'] = None
+        entry['updated'] = now
+        return entry
+
+    def record(self, channel, direction, msatoshi, failcode=None):
+        key = "%s/%d" % (channel, direction)
+        msatoshi = int(msatoshi)
+        with self.lock:
+            entry = self.__decayed(key, time.time())
+            if failcode is None:
+                entry['successes'] += 1
+                entry['max_success_msat'] = max(entry['max_success_msat'] or 0, msatoshi)
+            else:
+                entry['failures'] += 1
+                code = str(failcode)
+                entry['failcodes'][code] = entry['failcodes'].get(code, 0) + 1
+                if entry['min_failure_msat'] is None or msatoshi < entry['min_failure_msat']:
+                    entry['min_failure_msat'] = msatoshi
+
+    def record_route(self, route, error=None):
+        """Records the outcome of a payment over route.
+
+        On a failure the hops before the erring channel forwarded the
+        payment, the erring channel failed and nothing is known about the
+        hops after it.
+        """
+        data = error.error.get('data', {}) if error is not None else {}
+        erring_channel = data.get('erring_channel')
+        if error is not None and erring_channel not in [r['channel'] for r in route]:
+            return
+        for r in route:
+            if r['channel'] == erring_channel:
+                self.record(r['channel'], r['direction'], r['msatoshi'], data.get('failcode', 0))
+                return
+            self.record(r['channel'], r['direction'], r['msatoshi'])
+
+    def probability(self, channel, direction, msatoshi):
+        """Estimated probability that the channel direction forwards msatoshi.
+
+        Laplace estimate of the decayed counts, halved for amounts at or above
+        the smallest amount which failed recently.
+        """
+        key = "%s/%d" % (channel, direction)
+        with self.lock:
+            if key not in self.channels:
+                return 0.5
+            entry = self.__decayed(key, time.time())
+            p = (entry['successes'] + 1) / (entry['successes'] + entry['failures'] + 2)
+            if entry['min_failure_msat'] is not None and int(msatoshi) >= entry['min_failure_msat']:
+                if entry['max_success_msat'] is None or int(msatoshi) > entry['max_success_msat']:
+                    p /= 2
+        return p
+
+    def route_probability(self, route):
+        p = 1.0
+        for r in route:
+            p *= self.probability(r['channel'], r['direction'], r['msatoshi'])
+        return p
+
+
+def rank_routes(plugin, routes, route_out, route_in, msatoshi):
+    """Sorts routes by their expected fees per successful payment.
+
+    The fees of every route are divided by the estimated probability that
+    all hops after our outgoing channel forward the payment.
+    """
+    ranked = []
+    for i, route_mid in enumerate(routes):
+        route = [dict(route_out)] + [dict(h) for h in route_mid] + [dict(route_in)]
+        setup_routing_fees(plugin, route, msatoshi)
+        fees = int(route[0]['msatoshi'] - route[-1]['msatoshi'])
+        p = plugin.model.route_probability(route[1:])
+        ranked.append(((fees + 1) / p, i, route_mid))
+    return [route_mid for _, _, route_mid in sorted(ranked)]
+
+
+def channel_direction(source, destination):
+    # direction 0 is the channel half from the lesser to the greater node id
+    return 0 if source < destination else 1
+
 
 def setup_routing_fees(plugin, route, msatoshi):
     delay = int(plugin.get_option('cltv-final'))
     for r in reversed(route):
         r['msatoshi'] = r['amount_msat'] = msatoshi
         r['delay'] = delay
-        channels = plugin.rpc.listchannels(r['channel'])
-        for ch in channels.get('channels'):
-            if ch['destination'] == r['id']:
-                fee = Millisatoshi(ch['base_fee_millisatoshi'])
-                fee += msatoshi * ch['fee_per_millionth'] // 1000000
-                msatoshi += fee
-                delay += ch['delay']
+        ch = plugin.policies.get(plugin, r['channel'], r['direction'])
+        if ch is not None:
+            fee = Millisatoshi(ch.base_fee)
+            fee += msatoshi * ch.fee_per_millionth // 1000000
+            msatoshi += fee
+            delay += ch.delay
 
 
 def peer2channel(plugin, channel_id, my_node_id, payload):
@@ -54,30 +412,238 @@ def rebalance_fail(plugin, label, payload, success_msg, error=None):
     raise error
 
 
+def fees_exceed_limit(fees, msatoshi, maxfeepercent, exemptfee):
+    return fees > exemptfee and fees > msatoshi * float(maxfeepercent) / 100
+
+
+def route_excluded(route, excludes):
+    return any("%s/%d" % (h['channel'], h['direction']) in excludes for h in route)
+
+
+def handle_payment_error(plugin, e, payload, excludes, route):
+    """Records the failed payment over route and excludes the erring channel.
+
+    Raises if the outgoing or incoming channel of the rebalance failed.
+    """
+    plugin.log("RpcError: " + str(e))
+    plugin.model.record_route(route, e)
+    erring_channel = e.error.get('data', {}).get('erring_channel')
+    if erring_channel == payload['incoming_channel_id']:
+        raise RpcError("rebalance", payload, {'message': 'Error with incoming channel'})
+    if erring_channel == payload['outgoing_channel_id']:
+        raise RpcError("rebalance", payload, {'message': 'Error with outgoing channel'})
+    erring_direction = e.error.get('data', {}).get('erring_direction')
+    if erring_channel is not None and erring_direction is not None:
+        excludes.append(erring_channel + '/' + str(erring_direction))
+    if erring_channel is not None and e.error.get('data', {}).get('failcode', 0) & UPDATE:
+        # the erring node sent a channel_update, our policy is outdated
+        plugin.policies.invalidate(erring_channel)
+
+
+def final_node_failcode(e, route):
+    """Failcode if the final node of route, which is us, failed the payment."""
+    data = e.error.get('data', {})
+    if data.get('erring_index') != len(route):
+        return None
+    return data.get('failcode')
+
+
+def amount_to_incoming(plugin, route_in, msatoshi):
+    """Amount the incoming node must receive to forward msatoshi to us."""
+    policy_in = plugin.policies.get(plugin, route_in['channel'], route_in['direction'])
+    if policy_in is None:
+        return int(msatoshi)
+    return int(msatoshi) + ChannelGraph.fee(policy_in, int(msatoshi))
+
+
+def find_part_route(plugin, graph, route_out, route_in, incoming_node_id, amount, total,
+                    maxfeepercent, exemptfee, excludes, used):
+    """Cheapest route for one part whose fees are within the limits.
+
+    Routes are tried in the order of rank_routes. Channel directions in used
+    are avoided like excludes, but channels which
+    are too expensive are only added to excludes. The exempt fee is split
+    among the parts in proportion to their amounts.
+    """
+    amount = Millisatoshi(amount)
+    routes = graph.routes(route_out['id'], incoming_node_id, amount_to_incoming(plugin, route_in, amount),
+                          int(plugin.get_option('rebalance-routes')), excludes + used, [route_in['id']])
+    for route_mid in rank_routes(plugin, routes, route_out, route_in, amount):
+        if route_excluded(route_mid, excludes):
+            continue
+        route = [dict(route_out)] + [dict(h) for h in route_mid] + [dict(route_in)]
+        setup_routing_fees(plugin, route, amount)
+        fees = route[0]['msatoshi'] - route[-1]['msatoshi']
+        if not fees_exceed_limit(fees, amount, maxfeepercent, exemptfee * int(amount) // total):
+            return route, int(fees)
+        worst_channel_id = find_worst_channel(route)
+        if worst_channel_id is not None:
+            excludes += [worst_channel_id + '/0', worst_channel_id + '/1']
+    return None, None
+
+
+def send_parts(plugin, job, route_out, route_in, incoming_node_id, invoice, deadline, excludes):
+    """Sends the rebalance in parts over disjoint routes at the same time.
+
+    All parts share the payment hash and are told apart by their partid. The
+    parts are only resolved once all of them arrived, so a failed part is sent
+    again over another route. Part sizes are halved (down to an eighth of the
+    initial size) when a part failed or no route with enough capacity is
+    found, which raises the number of parts in flight. A part which timed out
+    at the destination waiting for the others is sent again, other failures
+    of the destination end the rebalance. Returns whether the payment
+    completed and a message about the progress.
+    """
+    payload = job.payload
+    graph = get_graph(plugin)
+    total = int(payload['msatoshi'])
+    part_size = -(-total // int(payload['parts']))
+    min_part = max(part_size // 8, 1)
+    pending = {}
+    sent = 0
+    next_partid = 1
+    # one thread waits for every part in flight
+    executor = ThreadPoolExecutor(max_workers=-(-total // min_part))
+    try:
+        while time.time() < deadline and not job.cancelled.is_set():
+            while sent < total:
+                amount = min(part_size, total - sent)
+                # routes of the parts must not share channels besides ours
+                used = [h['channel'] + '/' + str(d) for _, _, route, _ in pending.values()
+                        for h in route[1:-1] for d in (0, 1)]
+                route, fees = find_part_route(plugin, graph, route_out, route_in, incoming_node_id, amount, total,
+                                              payload['maxfeepercent'], payload['exemptfee'], excludes, used)
+                if route is None and used:
+                    # no disjoint route left, share channels with other parts
+                    route, fees = find_part_route(plugin, graph, route_out, route_in, incoming_node_id, amount,
+                                                  total, payload['maxfeepercent'], payload['exemptfee'], excludes, [])
+                if route is None:
+                    if part_size <= min_part:
+                        break
+                    part_size = max(part_size // 2, min_part)
+                    continue
+                partid = next_partid
+                next_partid += 1
+                plugin.log("Sending part %d of %s over %d hops to rebalance %s" % (partid, amount + fees, len(route), amount))
+                params = {'route': route, 'payment_hash': invoice['payment_hash'], 'msatoshi': total, 'partid': partid}
+                if 'payment_secret' in invoice:
+                    params['payment_secret'] = invoice['payment_secret']
+                plugin.rpc.call('sendpay', params)
+                future = executor.submit(plugin.rpc.call, 'waitsendpay', {
+                    'payment_hash': invoice['payment_hash'], 'partid': partid,
+                    'timeout': max(int(deadline - time.time()), 1)})
+                pending[future] = (partid, amount, route, fees)
+                sent += amount
+                job.attempts += 1
+                job.fees = sum(p[3] for p in pending.values())
+            if not pending:
+                raise RpcError("rebalance", payload, {'message': 'Cannot find a route'})
+
+            done, _ = wait(pending, max(deadline - time.time(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                partid, amount, route, fees = pending.pop(future)
+                try:
+                    future.result()
+                    # the parts are resolved together
+                    for _, _, other, _ in list(pending.values()) + [(partid, amount, route, fees)]:
+                        plugin.model.record_route(other)
+                    fees = sum(p[3] for p in pending.values()) + fees
+                    return True, "%d msat sent in %d parts to rebalance %d msat" % (total + fees, next_partid - 1, total)
+                except RpcError as e:
+                    failcode = final_node_failcode(e, route)
+                    if failcode == MPP_TIMEOUT:
+                        # every hop forwarded the part, only the set was incomplete in time
+                        plugin.log("Part %d of %d msat timed out at the destination" % (partid, amount))
+                        plugin.model.record_route(route)
+                    elif failcode is not None:
+                        raise RpcError("rebalance", payload, {
+                            'message': 'Incomplete MPP: part %d failed at the destination with failcode %d'
+                                       % (partid, failcode)})
+                    else:
+                        plugin.log("Part %d of %d msat failed" % (partid, amount))
+                        handle_payment_error(plugin, e, payload, excludes, route)
+                    sent -= amount
+                    job.fees -= fees
+                    part_size = max(min(part_size, amount // 2), min_part)
+        if job.cancelled.is_set():
+            return False, "%d of %d msat were in flight when the rebalance was cancelled" % (sent, total)
+        return False, "%d of %d msat were in flight when the rebalance timed out" % (sent, total)
+    finally:
+        executor.shutdown(wait=False)
+
+
+class RebalanceJob(object):
+    """State and progress of one rebalance, shared with the status methods."""
+    def __init__(self, outgoing_channel_id, incoming_channel_id, msatoshi, maxfeepercent, retry_for,
+                 exemptfee, parts):
+        self.id = str(uuid.uuid4())
+        self.payload = {
+            "outgoing_channel_id": outgoing_channel_id,
+            "incoming_channel_id": incoming_channel_id,
+            "msatoshi": msatoshi,
+            "maxfeepercent": maxfeepercent,
+            "retry_for": retry_for,
+            "exemptfee": exemptfee,
+            "parts": parts
+        }
+        self.state = "queued"
+        self.attempts = 0
+        self.excludes = []
+        self.fees = 0
+        self.result = None
+        self.created = time.time()
+        self.finished = None
+        self.future = None
+        self.cancelled = threading.Event()
+
+    def status(self):
+        status = dict(self.payload)
+        status.update({
+            "id": self.id,
+            "state": self.state,
+            "attempts": self.attempts,
+            "excludes": list(self.excludes),
+            "fees": int(self.fees),
+            "seconds": int((self.finished or time.time()) - self.created),
+        })
+        if self.result is not None:
+            status["result"] = self.result
+        return status
+
+
 @plugin.method("rebalance")
 def rebalance(plugin, outgoing_channel_id, incoming_channel_id, msatoshi: Millisatoshi,
-              maxfeepercent="0.5", retry_for="60", exemptfee: Millisatoshi=Millisatoshi(5000)):
+              maxfeepercent="0.5", retry_for="60", exemptfee: Millisatoshi=Millisatoshi(5000), parts="1"):
     """Rebalancing channel liquidity with circular payments.
 
     This tool helps to move some msatoshis between your channels.
+    With parts > 1 the amount is split and sent over several routes at once.
 
     """
-    payload = {
-        "outgoing_channel_id": outgoing_channel_id,
-        "incoming_channel_id": incoming_channel_id,
-        "msatoshi": msatoshi,
-        "maxfeepercent": maxfeepercent,
-        "retry_for": retry_for,
-        "exemptfee": exemptfee
-    }
+    job = RebalanceJob(outgoing_channel_id, incoming_channel_id, msatoshi, maxfeepercent, retry_for,
+                       exemptfee, parts)
+    return run_rebalance(plugin, job)
+
+
+def run_rebalance(plugin, job):
+    outgoing_channel_id = job.payload['outgoing_channel_id']
+    incoming_channel_id = job.payload['incoming_channel_id']
+    msatoshi = job.payload['msatoshi']
+    maxfeepercent = job.payload['maxfeepercent']
+    retry_for = job.payload['retry_for']
+    exemptfee = job.payload['exemptfee']
+    parts = job.payload['parts']
+    payload = job.payload
     my_node_id = plugin.rpc.getinfo().get('id')
     outgoing_node_id = peer2channel(plugin, outgoing_channel_id, my_node_id, payload)
     incoming_node_id = peer2channel(plugin, incoming_channel_id, my_node_id, payload)
     plugin.log("Outgoing node: %s, channel: %s" % (outgoing_node_id, outgoing_channel_id))
     plugin.log("Incoming node: %s, channel: %s" % (incoming_node_id, incoming_channel_id))
 
-    route_out = {'id': outgoing_node_id, 'channel': outgoing_channel_id}
-    route_in = {'id': my_node_id, 'channel': incoming_channel_id}
+    route_out = {'id': outgoing_node_id, 'channel': outgoing_channel_id,
+                 'direction': channel_direction(my_node_id, outgoing_node_id)}
+    route_in = {'id': my_node_id, 'channel': incoming_channel_id,
+                'direction': channel_direction(incoming_node_id, my_node_id)}
     start_ts = int(time.time())
     label = "Rebalance-" + str(uuid.uuid4())
     description = "%s to %s" % (outgoing_channel_id, incoming_channel_id)
@@ -86,15 +652,34 @@ def rebalance(plugin, outgoing_channel_id, incoming_channel_id, msatoshi: Millis
     plugin.log("Invoice payment_hash: %s" % payment_hash)
     success_msg = ""
     try:
-        excludes = [outgoing_channel_id + "/0", incoming_channel_id + "/0"]
+        excludes = job.excludes
+        excludes += [outgoing_channel_id + "/0", incoming_channel_id + "/0"]
+        if int(parts) > 1:
+            success_msg = "%d msat rebalanced in parts" % msatoshi
+            done, msg = send_parts(plugin, job, route_out, route_in, incoming_node_id, invoice,
+                                   start_ts + int(retry_for), excludes)
+            plugin.log(msg)
+            if done:
+                return msg
+            raise RpcError("rebalance", payload, {'message': 'Rebalance failed: ' + msg})
+        graph = get_graph(plugin)
+        msatoshi_in = amount_to_incoming(plugin, route_in, msatoshi)
+        routes = []
         while int(time.time()) - start_ts < int(retry_for):
-            r = plugin.rpc.getroute(incoming_node_id, msatoshi, riskfactor=1, cltv=9, fromid=outgoing_node_id,
-                                    exclude=excludes)
-            route_mid = r['route']
+            if job.cancelled.is_set():
+                raise RpcError("rebalance", payload, {'message': 'Rebalance cancelled'})
+            routes = [r for r in routes if not route_excluded(r, excludes)]
+            if not routes:
+                routes = graph.routes(outgoing_node_id, incoming_node_id, msatoshi_in,
+                                      int(plugin.get_option('rebalance-routes')), excludes, [my_node_id])
+                if not routes:
+                    raise RpcError("rebalance", payload, {'message': 'Cannot find a route'})
+                routes = rank_routes(plugin, routes, route_out, route_in, msatoshi)
+            route_mid = [dict(h) for h in routes.pop(0)]
             route = [route_out] + route_mid + [route_in]
             setup_routing_fees(plugin, route, msatoshi)
             fees = route[0]['msatoshi'] - route[-1]['msatoshi']
-            if fees > exemptfee and fees > msatoshi * float(maxfeepercent) / 100:
+            if fees_exceed_limit(fees, msatoshi, maxfeepercent, exemptfee):
                 worst_channel_id = find_worst_channel(route)
                 if worst_channel_id is None:
                     raise RpcError("rebalance", payload, {'message': 'Insufficient fee'})
@@ -105,30 +690,290 @@ def rebalance(plugin, outgoing_channel_id, incoming_channel_id, msatoshi: Millis
                 for r in route:
                     plugin.log("Node: %s, channel: %13s, %s" % (r['id'], r['channel'], r['msatoshi']))
                 success_msg = "%d msat sent over %d hops to rebalance %d msat" % (msatoshi + fees, len(route), msatoshi)
+                job.attempts += 1
+                job.fees = fees
                 plugin.rpc.sendpay(route, payment_hash)
                 plugin.rpc.waitsendpay(payment_hash, int(retry_for) + start_ts - int(time.time()))
+                plugin.model.record_route(route)
                 return success_msg
             except RpcError as e:
-                plugin.log("RpcError: " + str(e))
-                erring_channel = e.error.get('data', {}).get('erring_channel')
-                if erring_channel == incoming_channel_id:
-                    raise RpcError("rebalance", payload, {'message': 'Error with incoming channel'})
-                if erring_channel == outgoing_channel_id:
-                    raise RpcError("rebalance", payload, {'message': 'Error with outgoing channel'})
-                erring_direction = e.error.get('data', {}).get('erring_direction')
-                if erring_channel is not None and erring_direction is not None:
-                    excludes.append(erring_channel + '/' + str(erring_direction))
+                handle_payment_error(plugin, e, payload, excludes, route)
     except Exception as e:
         plugin.log("Exception: " + str(e))
         return rebalance_fail(plugin, label, payload, success_msg, e)
+    finally:
+        plugin.log(plugin.policies.stats())
+        try:
+            plugin.model.save()
+        except OSError as e:
+            plugin.log("Could not save the channel statistics: " + str(e))
     return rebalance_fail(plugin, label, payload, success_msg)
 
 
+def run_job(plugin, job):
+    if job.cancelled.is_set():
+        job.state = "cancelled"
+        job.finished = time.time()
+        return
+    job.state = "running"
+    try:
+        job.result = run_rebalance(plugin, job)
+        job.state = "succeeded"
+    except Exception as e:
+        job.result = str(e)
+        job.state = "cancelled" if job.cancelled.is_set() else "failed"
+    finally:
+        job.finished = time.time()
+
+
+@plugin.method("rebalancesubmit")
+def rebalancesubmit(plugin, outgoing_channel_id, incoming_channel_id, msatoshi: Millisatoshi,
+                    maxfeepercent="0.5", retry_for="60", exemptfee: Millisatoshi=Millisatoshi(5000), parts="1"):
+    """Starts a rebalance in the background and returns its job id.
+
+    Takes the same arguments as rebalance. Progress is reported by
+    rebalancestatus and the job can be stopped with rebalancecancel.
+    """
+    job = RebalanceJob(outgoing_channel_id, incoming_channel_id, msatoshi, maxfeepercent, retry_for,
+                       exemptfee, parts)
+    add_job(plugin, job)
+    submit_job(plugin, job)
+    return {"id": job.id}
+
+
+def add_job(plugin, job):
+    with plugin.jobs_lock:
+        plugin.jobs[job.id] = job
+        # forget the oldest finished jobs
+        finished = sorted((j for j in plugin.jobs.values() if j.finished), key=lambda j: j.finished)
+        for j in finished[:max(len(plugin.jobs) - int(plugin.get_option('rebalance-jobs')), 0)]:
+            del plugin.jobs[j.id]
+
+
+def submit_job(plugin, job):
+    job.future = plugin.executor.submit(run_job, plugin, job)
+    return job.future
+
+
+def get_job(plugin, job_id):
+    with plugin.jobs_lock:
+        job = plugin.jobs.get(job_id)
+    if job is None:
+        raise RpcError("rebalance", {"job_id": job_id}, {'message': 'Unknown job: ' + job_id})
+    return job
+
+
+@plugin.method("rebalancestatus")
+def rebalancestatus(plugin, job_id=None):
+    """Shows progress and result of the background rebalance {job_id}, or of all of them."""
+    if job_id is not None:
+        return get_job(plugin, job_id).status()
+    with plugin.jobs_lock:
+        jobs = sorted(plugin.jobs.values(), key=lambda j: j.created)
+    return {"jobs": [job.status() for job in jobs]}
+
+
+@plugin.method("rebalancecancel")
+def rebalancecancel(plugin, job_id):
+    """Cancels the background rebalance {job_id}.
+
+    A payment which is already on its way is not aborted, the job stops
+    before its next attempt.
+    """
+    job = get_job(plugin, job_id)
+    job.cancelled.set()
+    # jobs of rebalanceall may not be submitted yet
+    if job.future is None or job.future.cancel():
+        job.state = "cancelled"
+        job.finished = time.time()
+    return job.status()
+
+
+def channel_imbalances(plugin, threshold):
+    """Surplus and deficit of every active channel, relative to an even split.
+
+    Returns two dicts short_channel_id -> (peer id, msatoshi) of the channels
+    whose share of our funds is above respectively below 50% by more than
+    threshold.
+    """
+    surplus = {}
+    deficit = {}
+    for peer in plugin.rpc.listpeers().get('peers'):
+        if not peer['connected']:
+            continue
+        for ch in peer['channels']:
+            if ch['state'] != 'CHANNELD_NORMAL' or 'short_channel_id' not in ch:
+                continue
+            to_us = int(ch['to_us_msat'])
+            total = int(ch['total_msat'])
+            imbalance = to_us - total // 2
+            if abs(imbalance) <= threshold * total:
+                continue
+            if imbalance > 0:
+                surplus[ch['short_channel_id']] = (peer['id'], imbalance)
+            else:
+                deficit[ch['short_channel_id']] = (peer['id'], -imbalance)
+    return surplus, deficit
+
+
+def plan_rebalances(plugin, graph, my_node_id, surplus, deficit, feebudget, parts=1):
+    """Matches surplus to deficit channels within the fee budget.
+
+    Pairs are ordered by the fee rate of one of parts parts of the whole
+    deficit, estimated on the local graph. They are then matched greedily,
+    cheapest first, moving as much as both channels allow. The fee of every
+    match is estimated again for the amount actually moved, so the base fees
+    of every hop and part count, and the amount is halved until the estimate
+    fits into the budget. Every match reserves up to FEE_HEADROOM times its
+    estimate. The budget left
+    after matching is shared among the rebalances in proportion to their
+    estimates, so retries over costlier routes can succeed.
+    Returns a list of (outgoing channel, incoming channel, msatoshi, estimated fee, fee allowance).
+    """
+    searches = {}
+
+    def estimate(outgoing, incoming, msatoshi):
+        part = -(-msatoshi // parts)
+        incoming_node_id = deficit[incoming][0]
+        if (incoming, part) not in searches:
+            direction = channel_direction(incoming_node_id, my_node_id)
+            msatoshi_in = amount_to_incoming(plugin, {'channel': incoming, 'direction': direction}, part)
+            searches[(incoming, part)] = graph.amounts_to(incoming_node_id, msatoshi_in, [my_node_id])
+        amounts = searches[(incoming, part)]
+        outgoing_node_id = surplus[outgoing][0]
+        if outgoing_node_id == incoming_node_id or outgoing_node_id not in amounts:
+            return None
+        return (amounts[outgoing_node_id] - part) * parts
+
+    pairs = []
+    for incoming, (_, amount) in deficit.items():
+        for outgoing in surplus:
+            fee = estimate(outgoing, incoming, amount)
+            if fee is not None:
+                pairs.append((fee / amount, outgoing, incoming))
+
+    left = {k: v[1] for k, v in surplus.items()}
+    left.update({k: v[1] for k, v in deficit.items()})
+    budget = int(feebudget)
+    matches = []
+    for _, outgoing, incoming in sorted(pairs):
+        msatoshi = min(left[outgoing], left[incoming])
+        while msatoshi >= parts:
+            fee = estimate(outgoing, incoming, msatoshi)
+            if fee is not None and fee < budget:
+                break
+            msatoshi //= 2
+        if msatoshi < parts:
+            continue
+        reserve = min(int(fee * FEE_HEADROOM) + 1, budget)
+        left[outgoing] -= msatoshi
+        left[incoming] -= msatoshi
+        budget -= reserve
+        matches.append((outgoing, incoming, msatoshi, fee, reserve))
+
+    total = sum(fee for _, _, _, fee, _ in matches)
+    plan = []
+    for outgoing, incoming, msatoshi, fee, reserve in matches:
+        share = budget * fee // total if total else budget // len(matches)
+        plan.append((outgoing, incoming, msatoshi, fee, reserve + share))
+    return plan
+
+
+@plugin.method("rebalanceall")
+def rebalanceall(plugin, feebudget: Millisatoshi, threshold="0.1", retry_for="60", parallel="4", parts="1"):
+    """Rebalancing all channels whose funds are not evenly split.
+
+    Matches channels with a surplus to channels with a deficit and spends at
+    most {feebudget} on fees. Channels within {threshold} of an even split are
+    left alone. The rebalances run as background jobs, up to {parallel} at
+    the same time, and their job ids are returned right away.
+
+    """
+    my_node_id = plugin.rpc.getinfo().get('id')
+    surplus, deficit = channel_imbalances(plugin, float(threshold))
+    plugin.log("Channels with surplus: %d, with deficit: %d" % (len(surplus), len(deficit)))
+    plan = plan_rebalances(plugin, get_graph(plugin), my_node_id, surplus, deficit, feebudget, int(parts))
+
+    # every rebalance may spend its fee allowance, whatever the amount
+    jobs = []
+    rebalances = []
+    for outgoing, incoming, msatoshi, fee, allowance in plan:
+        job = RebalanceJob(outgoing, incoming, Millisatoshi(msatoshi), "0", retry_for,
+                           Millisatoshi(allowance), parts)
+        add_job(plugin, job)
+        jobs.append(job)
+        rebalances.append({"id": job.id, "outgoing_channel_id": outgoing, "incoming_channel_id": incoming,
+                           "msatoshi": msatoshi, "estimated_fee": fee, "fee_allowance": allowance})
+    thread = threading.Thread(target=dispatch_jobs, args=(plugin, jobs, int(parallel)), daemon=True)
+    thread.start()
+    return {
+        "planned": len(jobs),
+        "rebalances": rebalances
+    }
+
+
+def dispatch_jobs(plugin, jobs, parallel):
+    """Submits jobs, at most parallel at a time and one per channel at a time."""
+    queue = list(jobs)
+    busy = set()
+    pending = {}
+    while queue or pending:
+        for job in list(queue):
+            if job.cancelled.is_set():
+                queue.remove(job)
+                continue
+            if len(pending) >= parallel:
+                break
+            channels = {job.payload["outgoing_channel_id"], job.payload["incoming_channel_id"]}
+            if channels & busy:
+                continue
+            queue.remove(job)
+            busy |= channels
+            plugin.log("Rebalance %s msat from %s to %s" % (job.payload["msatoshi"], job.payload["outgoing_channel_id"],
+                                                           job.payload["incoming_channel_id"]))
+            pending[submit_job(plugin, job)] = job
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            job = pending.pop(future)
+            busy -= {job.payload["outgoing_channel_id"], job.payload["incoming_channel_id"]}
+
+    succeeded = len([job for job in jobs if job.state == "succeeded"])
+    plugin.log("Rebalanced %d of %d planned channel pairs" % (succeeded, len(jobs)))
+
+
 @plugin.init()
 def init(options, configuration, plugin):
     plugin.options['cltv-final']['value'] = plugin.rpc.listconfigs().get('cltv-final')
+    plugin.graph = None
+    plugin.graph_lock = threading.Lock()
+    plugin.jobs = {}
+    plugin.jobs_lock = threading.Lock()
+    plugin.executor = ThreadPoolExecutor(max_workers=int(plugin.get_option('rebalance-workers')))
+    plugin.model = SuccessModel(os.path.join(configuration['lightning-dir'], 'rebalance-history.json'),
+                                int(plugin.get_option('rebalance-history-halflife')))
+    try:
+        plugin.model.load()
+    except FileNotFoundError:
+        pass
+    except ValueError as e:
+        # keep the corrupt file for inspection instead of overwriting it
+        os.rename(plugin.model.path, plugin.model.path + '.corrupt')
+        plugin.log("Corrupt channel statistics moved to %s.corrupt, starting without history: %s"
+                   % (plugin.model.path, str(e)), 'warn')
+    plugin.policies = PolicyCache(int(plugin.get_option('rebalance-policy-ttl')),
+                                  int(plugin.get_option('rebalance-policy-cache-size')))
+    GraphThread(plugin)
     plugin.log("Plugin rebalance.py initialized")
 
 
 plugin.add_option('cltv-final', 10, 'Number of blocks for final CheckLockTimeVerify expiry')
+plugin.add_option('rebalance-graph-refresh', 600, 'Seconds after which the local copy of the channel graph is refreshed')
+plugin.add_option('rebalance-routes', 5, 'Number of cheapest routes computed at once for the retries')
+plugin.add_option('rebalance-policy-ttl', 300, 'Seconds for which fee and delay policies of channels are cached')
+plugin.add_option('rebalance-policy-cache-size', 10000, 'Maximal number of cached channel policies')
+plugin.add_option('rebalance-history-halflife', 86400, 'Seconds after which past payment attempts count half')
+plugin.add_option('rebalance-workers', 4, 'Number of background rebalances which run at the same time')
+plugin.add_option('rebalance-jobs', 100, 'Number of background rebalances whose status is kept')
 plugin.run()